@@ -4,7 +4,15 @@ import asyncio
 import datetime
 import os
 import json
+import gzip
+import functools
+import shutil
+import time
+import bisect
 import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import nest_asyncio
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 import telegram.error
@@ -16,7 +24,9 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
 )
+from conversation_persistence import SQLitePersistence, SQL_CREATE_CONVERSATIONS, SQL_CREATE_USER_CONTEXT
 
 nest_asyncio.apply()
 
@@ -39,6 +49,31 @@ MANDATORY_CHANNEL = "@bxbxbxbxjxxj"       # Replace with your actual channel use
 # Global modifiable product prices dictionary with an initial product.
 PRODUCT_PRICES = {"🍔کد 170/300 اسنپ فود🍕": 30000}
 
+USER_CACHE_SIZE = 10000                # users kept in memory; the rest stay in SQLite until touched
+
+# SQLite
+DB_FILE = "user_data.db"
+DB_SCHEMA_VERSION = 3                  # PRAGMA user_version; 2 = purchases live in their own table, 3 = bot state tables
+DB_READ_THREADS = 4                    # reader connections; writes go through one dedicated thread
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",         # readers never wait for the writer
+    "PRAGMA synchronous=NORMAL",       # fsync at checkpoints only; safe with WAL
+    "PRAGMA cache_size=-16000",        # 16 MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+CONVERSATION_PERSIST_INTERVAL = 10     # seconds between writes of conversation states and context.user_data
+CONVERSATION_TIMEOUT = 600             # seconds an admin flow may wait for its next message before it ends
+CONTEXT_CLEANUP_INTERVAL = 3600        # seconds between sweeps of context.user_data
+CONTEXT_MAX_IDLE = 86400               # context.user_data of a user idle this long is dropped
+
+# Online backups
+BACKUP_DIR = "backups"                 # compressed database copies, newest last by name
+BACKUP_INTERVAL = 6 * 3600             # seconds between scheduled backups
+BACKUP_KEEP = 28                       # backups kept before the oldest are deleted
+BACKUP_COMPRESS_LEVEL = 6              # gzip level for backup files
+
 # =====================================================================
 # Conversation States for User and Admin Tasks
 # =====================================================================
@@ -94,15 +129,25 @@ ADMIN_DELETE_CODE_INPUT = 601
 # =====================================================================
 # Global Dictionaries and Sets for Data Storage
 # =====================================================================
-# Instead of file-based storage, we use SQLite for persistence.
-USER_BALANCES = {}                     # user_id -> current balance
-USER_CHARGED = {}                      # user_id -> total charged amount
-USER_PURCHASED = {}                    # user_id -> total purchased count
-USER_RECENT_PURCHASES = {}             # user_id -> list of tuples (timestamp, product)
+# Instead of file-based storage, we use SQLite for persistence. Users are
+# read on first touch and kept in a bounded LRU cache; every change is
+# written straight back, so an evicted user never has unsaved state.
+class UserRecord:
+    __slots__ = ("balance", "charged", "purchased", "purchases")
+
+    def __init__(self, balance: int = 0, charged: int = 0, purchased: int = 0, purchases: list = None):
+        self.balance = balance              # current balance
+        self.charged = charged              # total charged amount
+        self.purchased = purchased          # total purchased count
+        self.purchases = purchases if purchases is not None else []   # (epoch seconds, product id) tuples
+
+USER_CACHE = OrderedDict()             # user_id -> UserRecord, least recently used first
 BANNED_USERS = {}                      # user_id -> True if banned
 
 SERVICE_CODES = {}                     # product name -> list of available codes
 SERVICE_FILE_PATH = {}                 # product name -> file path
+PRODUCT_NAMES = []                     # product id -> product name (mirrors the products table)
+PRODUCT_IDS = {}                       # product name -> product id
 
 REGISTERED_USERS = set()               # Users who started the bot (for broadcast)
 
@@ -111,51 +156,423 @@ BOT_ACTIVE = True                      # Global bot status
 # =====================================================================
 # Database Functions using SQLite
 # =====================================================================
-db = None
-
-def init_db():
-    global db
-    db = sqlite3.connect("user_data.db", check_same_thread=False)
-    cursor = db.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            balance INTEGER,
-            charged INTEGER,
-            purchased INTEGER,
-            recent_purchases TEXT
-        )
-    """)
-    db.commit()
-
-def load_user_data():
-    global USER_BALANCES, USER_CHARGED, USER_PURCHASED, USER_RECENT_PURCHASES
-    cursor = db.cursor()
-    cursor.execute("SELECT user_id, balance, charged, purchased, recent_purchases FROM users")
-    rows = cursor.fetchall()
-    for row in rows:
-        user_id, balance, charged, purchased, recent_purchases_text = row
-        USER_BALANCES[user_id] = balance
-        USER_CHARGED[user_id] = charged
-        USER_PURCHASED[user_id] = purchased
+# Statements are module constants so each connection's statement cache
+# (sqlite3's cached_statements) prepares them once and reuses them.
+SQL_CREATE_USERS = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER,
+        charged INTEGER,
+        purchased INTEGER,
+        recent_purchases TEXT
+    )
+"""
+SQL_CREATE_PRODUCTS = """
+    CREATE TABLE IF NOT EXISTS products (
+        product_id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE
+    )
+"""
+SQL_CREATE_PURCHASES = """
+    CREATE TABLE IF NOT EXISTS purchases (
+        user_id INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        price INTEGER
+    )
+"""
+SQL_CREATE_PURCHASES_BY_USER = "CREATE INDEX IF NOT EXISTS purchases_by_user ON purchases (user_id, timestamp)"
+SQL_CREATE_PURCHASES_BY_TIME = "CREATE INDEX IF NOT EXISTS purchases_by_time ON purchases (timestamp)"
+SQL_SELECT_USER = "SELECT balance, charged, purchased FROM users WHERE user_id = ?"
+SQL_UPSERT_USER = """
+    INSERT INTO users (user_id, balance, charged, purchased) VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET balance = excluded.balance, charged = excluded.charged, purchased = excluded.purchased
+"""
+SQL_SELECT_PRODUCTS = "SELECT product_id, name FROM products ORDER BY product_id"
+SQL_INSERT_PRODUCT = "INSERT INTO products (product_id, name) VALUES (?, ?)"
+SQL_SELECT_USER_PURCHASES = "SELECT timestamp, product_id FROM purchases WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp"
+SQL_INSERT_PURCHASE = "INSERT INTO purchases (user_id, timestamp, product_id, price) VALUES (?, ?, ?, ?)"
+SQL_SELECT_LEGACY_PURCHASES = "SELECT user_id, recent_purchases FROM users WHERE recent_purchases IS NOT NULL"
+SQL_CLEAR_LEGACY_PURCHASES = "UPDATE users SET recent_purchases = NULL"
+SQL_SALES_SINCE = "SELECT COUNT(*) FROM purchases WHERE timestamp >= ?"
+SQL_TOP_BUYER_SINCE = """
+    SELECT user_id, COUNT(*) AS bought FROM purchases WHERE timestamp >= ?
+    GROUP BY user_id ORDER BY bought DESC LIMIT 1
+"""
+SQL_CHARGE_TOTALS = "SELECT COALESCE(SUM(charged), 0), COALESCE(MAX(charged), 0) FROM users"
+
+# Bot state: one row per registered user, product, code and setting, so
+# each change is a single-row insert, update or delete.
+SQL_CREATE_REGISTERED_USERS = "CREATE TABLE IF NOT EXISTS registered_users (user_id INTEGER PRIMARY KEY)"
+SQL_CREATE_BANNED_USERS = "CREATE TABLE IF NOT EXISTS banned_users (user_id INTEGER PRIMARY KEY)"
+SQL_CREATE_CATALOG = "CREATE TABLE IF NOT EXISTS catalog (name TEXT PRIMARY KEY, price INTEGER NOT NULL)"
+SQL_CREATE_SERVICE_FILES = "CREATE TABLE IF NOT EXISTS service_files (product TEXT PRIMARY KEY, file_path TEXT NOT NULL)"
+SQL_CREATE_SERVICE_CODES = "CREATE TABLE IF NOT EXISTS service_codes (product TEXT NOT NULL, code TEXT NOT NULL)"
+SQL_CREATE_SERVICE_CODES_BY_PRODUCT = "CREATE INDEX IF NOT EXISTS service_codes_by_product ON service_codes (product)"
+SQL_CREATE_SETTINGS = "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)"
+SQL_SELECT_REGISTERED_USERS = "SELECT user_id FROM registered_users"
+SQL_INSERT_REGISTERED_USER = "INSERT OR IGNORE INTO registered_users (user_id) VALUES (?)"
+SQL_SELECT_BANNED_USERS = "SELECT user_id FROM banned_users"
+SQL_INSERT_BANNED_USER = "INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)"
+SQL_DELETE_BANNED_USER = "DELETE FROM banned_users WHERE user_id = ?"
+SQL_SELECT_CATALOG = "SELECT name, price FROM catalog ORDER BY rowid"
+SQL_UPSERT_CATALOG = "INSERT INTO catalog (name, price) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET price = excluded.price"
+SQL_DELETE_CATALOG = "DELETE FROM catalog WHERE name = ?"
+SQL_SELECT_SERVICE_FILES = "SELECT product, file_path FROM service_files"
+SQL_UPSERT_SERVICE_FILE = """
+    INSERT INTO service_files (product, file_path) VALUES (?, ?)
+    ON CONFLICT (product) DO UPDATE SET file_path = excluded.file_path
+"""
+SQL_DELETE_SERVICE_FILE = "DELETE FROM service_files WHERE product = ?"
+SQL_SELECT_SERVICE_CODES = "SELECT product, code FROM service_codes ORDER BY rowid"
+SQL_INSERT_SERVICE_CODE = "INSERT INTO service_codes (product, code) VALUES (?, ?)"
+SQL_DELETE_SERVICE_CODES = "DELETE FROM service_codes WHERE product = ?"
+# Codes are handed out oldest first, like SERVICE_CODES[product].pop(0).
+SQL_DELETE_FIRST_SERVICE_CODE = "DELETE FROM service_codes WHERE rowid = (SELECT MIN(rowid) FROM service_codes WHERE product = ?)"
+SQL_SELECT_SETTING = "SELECT value FROM settings WHERE key = ?"
+SQL_UPSERT_SETTING = "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+
+class Database:
+    # Blocking sqlite3 calls run on worker threads, one connection per thread:
+    # a single writer thread keeps writes ordered, and a small reader pool lets
+    # profile / balance lookups run alongside write bursts under WAL.
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self.readers = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, cached_statements=256)
+            for pragma in DB_PRAGMAS:
+                connection.execute(pragma)
+            self.local.connection = connection
+        return connection
+
+    def _fetchone(self, sql: str, params: tuple):
+        return self.connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        return self.connection().execute(sql, params).fetchall()
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        connection = self.connection()
+        connection.execute(sql, params)
+        connection.commit()
+
+    def _executemany(self, sql: str, rows: list) -> None:
+        connection = self.connection()
+        connection.executemany(sql, rows)
+        connection.commit()
+
+    def _executebatch(self, steps: list) -> None:
+        # (sql, rows) steps applied in one transaction.
+        connection = self.connection()
         try:
-            USER_RECENT_PURCHASES[user_id] = json.loads(recent_purchases_text) if recent_purchases_text else []
+            for sql, rows in steps:
+                connection.executemany(sql, rows)
         except Exception:
-            USER_RECENT_PURCHASES[user_id] = []
-
-def save_all_user_data():
-    cursor = db.cursor()
-    for user_id in USER_BALANCES.keys():
-        balance = USER_BALANCES.get(user_id, 0)
-        charged = USER_CHARGED.get(user_id, 0)
-        purchased = USER_PURCHASED.get(user_id, 0)
-        recent_purchases = USER_RECENT_PURCHASES.get(user_id, [])
-        recent_purchases_str = json.dumps(recent_purchases, ensure_ascii=False)
-        cursor.execute(
-            "INSERT OR REPLACE INTO users (user_id, balance, charged, purchased, recent_purchases) VALUES (?, ?, ?, ?, ?)",
-            (user_id, balance, charged, purchased, recent_purchases_str)
-        )
-    db.commit()
+            connection.rollback()
+            raise
+        connection.commit()
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self._fetchone, sql, params)
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self._fetchall, sql, params)
+
+    async def execute(self, sql: str, params: tuple = ()) -> None:
+        await asyncio.wrap_future(self.writer.submit(self._execute, sql, params))
+
+    async def executemany(self, sql: str, rows: list) -> None:
+        await asyncio.wrap_future(self.writer.submit(self._executemany, sql, rows))
+
+    async def executebatch(self, steps: list) -> None:
+        await asyncio.wrap_future(self.writer.submit(self._executebatch, steps))
+
+    def _backup(self, path: str) -> None:
+        # One step copies the whole database inside a single read transaction:
+        # under WAL that is a consistent snapshot and the writer is never blocked.
+        target = sqlite3.connect(path)
+        try:
+            self.connection().backup(target)
+        finally:
+            target.close()
+
+    async def backup(self, path: str) -> None:
+        await asyncio.get_running_loop().run_in_executor(self.readers, self._backup, path)
+
+    def submit(self, sql: str, params: tuple = ()):
+        # Queues a write without waiting for it; later writes still run after it.
+        # Nobody awaits the future, so a failure is logged here or not at all.
+        future = self.writer.submit(self._execute, sql, params)
+        future.add_done_callback(functools.partial(log_failed_write, sql, params))
+        return future
+
+def log_failed_write(sql: str, params: tuple, future) -> None:
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Database write failed: {' '.join(sql.split())} {params}", exc_info=error)
+
+db = Database(DB_FILE)
+
+async def init_db():
+    for sql in (SQL_CREATE_USERS, SQL_CREATE_PRODUCTS, SQL_CREATE_PURCHASES,
+                SQL_CREATE_PURCHASES_BY_USER, SQL_CREATE_PURCHASES_BY_TIME,
+                SQL_CREATE_REGISTERED_USERS, SQL_CREATE_BANNED_USERS, SQL_CREATE_CATALOG,
+                SQL_CREATE_SERVICE_FILES, SQL_CREATE_SERVICE_CODES, SQL_CREATE_SERVICE_CODES_BY_PRODUCT,
+                SQL_CREATE_SETTINGS, SQL_CREATE_CONVERSATIONS, SQL_CREATE_USER_CONTEXT):
+        await db.execute(sql)
+    await load_product_ids()
+    (version,) = await db.fetchone("PRAGMA user_version")
+    if version < 2:
+        await move_legacy_purchases()
+    if version < 3:
+        # The catalog starts from the built-in products; after that the table is the source.
+        await db.executemany(SQL_UPSERT_CATALOG, list(PRODUCT_PRICES.items()))
+    await db.execute(f"PRAGMA user_version = {DB_SCHEMA_VERSION}")
+    await load_bot_state()
+
+async def load_bot_state():
+    global BOT_ACTIVE
+    REGISTERED_USERS.update(user_id for (user_id,) in await db.fetchall(SQL_SELECT_REGISTERED_USERS))
+    BANNED_USERS.update((user_id, True) for (user_id,) in await db.fetchall(SQL_SELECT_BANNED_USERS))
+    PRODUCT_PRICES.clear()
+    for name, price in await db.fetchall(SQL_SELECT_CATALOG):
+        PRODUCT_PRICES[name] = price
+        SERVICE_CODES[name] = []
+    for product, code in await db.fetchall(SQL_SELECT_SERVICE_CODES):
+        SERVICE_CODES.setdefault(product, []).append(code)
+    SERVICE_FILE_PATH.update(await db.fetchall(SQL_SELECT_SERVICE_FILES))
+    row = await db.fetchone(SQL_SELECT_SETTING, ("bot_active",))
+    if row is not None:
+        BOT_ACTIVE = row[0] == "1"
+
+async def set_bot_active(active: bool):
+    global BOT_ACTIVE
+    BOT_ACTIVE = active
+    await db.execute(SQL_UPSERT_SETTING, ("bot_active", "1" if active else "0"))
+
+async def move_legacy_purchases():
+    # Version 1 kept each user's purchases as a JSON list in users.recent_purchases.
+    rows = []
+    for user_id, recent_purchases_text in await db.fetchall(SQL_SELECT_LEGACY_PURCHASES):
+        try:
+            purchases = parse_purchase_history(json.loads(recent_purchases_text))
+        except Exception:
+            continue
+        rows.extend((user_id, timestamp, product, None) for timestamp, product in purchases)
+    await db.executemany(SQL_INSERT_PURCHASE, rows)
+    await db.execute(SQL_CLEAR_LEGACY_PURCHASES)
+
+async def load_product_ids():
+    for product_id, name in await db.fetchall(SQL_SELECT_PRODUCTS):
+        PRODUCT_IDS[name] = product_id
+        PRODUCT_NAMES.append(name)
+
+def get_product_id(product: str) -> int:
+    product_id = PRODUCT_IDS.get(product)
+    if product_id is None:
+        product_id = len(PRODUCT_NAMES)
+        db.submit(SQL_INSERT_PRODUCT, (product_id, product))
+        PRODUCT_IDS[product] = product_id
+        PRODUCT_NAMES.append(product)
+    return product_id
+
+async def fetch_user(user_id: int):
+    row = await db.fetchone(SQL_SELECT_USER, (user_id,))
+    if row is None:
+        return None
+    balance, charged, purchased = row
+    cutoff = epoch_seconds(datetime.datetime.utcnow() - datetime.timedelta(days=PURCHASES_LOADED_DAYS))
+    purchases = [tuple(entry) for entry in await db.fetchall(SQL_SELECT_USER_PURCHASES, (user_id, cutoff))]
+    return UserRecord(balance or 0, charged or 0, purchased or 0, purchases)
+
+async def get_user(user_id: int) -> UserRecord:
+    record = USER_CACHE.get(user_id)
+    if record is not None:
+        USER_CACHE.move_to_end(user_id)
+        return record
+    fetched = await fetch_user(user_id) or UserRecord()
+    # Another handler may have loaded (and changed) this user while we waited.
+    record = USER_CACHE.get(user_id)
+    if record is not None:
+        return record
+    record = USER_CACHE[user_id] = fetched
+    if len(USER_CACHE) > USER_CACHE_SIZE:
+        USER_CACHE.popitem(last=False)
+    return record
+
+async def save_user(user_id: int):
+    record = await get_user(user_id)
+    await db.execute(SQL_UPSERT_USER, (user_id, record.balance, record.charged, record.purchased))
+
+# =====================================================================
+# Conversation Persistence
+# =====================================================================
+# Admin conversation states and context.user_data are kept in the
+# conversations and user_context tables by conversation_persistence.SQLitePersistence.
+
+# Handlers never remove their context.user_data keys, and PTB keeps a dict
+# for every user it has seen. Flows that time out clear theirs right away;
+# the worker below drops empty dicts and those of users idle for
+# CONTEXT_MAX_IDLE, which covers flows whose timeout never ran (e.g. ones
+# restored after a restart).
+CONTEXT_LAST_SEEN = {}                 # user_id -> monotonic time of the last update, for users holding context.user_data
+
+async def note_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user and context.user_data:
+        CONTEXT_LAST_SEEN[update.effective_user.id] = time.monotonic()
+
+def conversation_timed_out(*keys: str) -> TypeHandler:
+    # A flow's TIMEOUT state pops only that flow's keys, so the admin's other
+    # flows still in progress keep theirs.
+    async def timed_out(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        for key in keys:
+            context.user_data.pop(key, None)
+    return TypeHandler(Update, timed_out)
+
+async def user_context_cleanup_worker(application: Application) -> None:
+    while True:
+        await asyncio.sleep(CONTEXT_CLEANUP_INTERVAL)
+        now = time.monotonic()
+        dropped = 0
+        for user_id, data in list(application.user_data.items()):
+            if data:
+                # Users with data from before the first sweep count as seen now.
+                last_seen = CONTEXT_LAST_SEEN.setdefault(user_id, now)
+                if now - last_seen < CONTEXT_MAX_IDLE:
+                    continue
+                dropped += 1
+            CONTEXT_LAST_SEEN.pop(user_id, None)
+            application.drop_user_data(user_id)
+        if dropped:
+            logger.info(f"Dropped idle context.user_data of {dropped} users")
+
+# =====================================================================
+# Online Backups
+# =====================================================================
+def compress_file(source: str, target: str) -> None:
+    with open(source, "rb") as src, gzip.open(target, "wb", compresslevel=BACKUP_COMPRESS_LEVEL) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+async def backup_database() -> dict:
+    started = time.perf_counter()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"user_data-{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.db"
+    copy_path = os.path.join(BACKUP_DIR, name + ".tmp")
+    path = os.path.join(BACKUP_DIR, name + ".gz")
+    await db.backup(copy_path)
+    copied = time.perf_counter()
+    try:
+        await asyncio.to_thread(compress_file, copy_path, path)
+    finally:
+        os.remove(copy_path)
+    for old_backup in sorted(name for name in os.listdir(BACKUP_DIR) if name.endswith(".db.gz"))[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, old_backup))
+    return {"path": path, "bytes": os.path.getsize(path),
+            "copy": copied - started, "compress": time.perf_counter() - copied}
+
+async def run_backup(bot, chat_id: int = None) -> None:
+    try:
+        result = await backup_database()
+    except Exception as e:
+        logger.exception("Backup failed")
+        if chat_id is not None:
+            await bot.send_message(chat_id=chat_id, text=f"❌پشتیبان‌گیری ناموفق بود: {e}")
+        return
+    logger.info(f"Backup written to {result['path']} (copy {result['copy']:.2f}s, compress {result['compress']:.2f}s)")
+    if chat_id is not None:
+        await bot.send_message(chat_id=chat_id, text=(
+            f"✅پشتیبان ذخیره شد: {result['path']}\n"
+            f"📦حجم: {result['bytes'] / 2**20:.1f} MB\n"
+            f"⏱کپی: {result['copy']:.2f}s | فشرده‌سازی: {result['compress']:.2f}s"))
+
+BACKUP_RUNS = set()                    # scheduled backups in progress; on_stop() lets them finish
+
+async def backup_worker(application: Application) -> None:
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        # Cancelling the worker must not abandon a backup whose write is
+        # already running on a worker thread; on_stop() waits for it instead.
+        run = asyncio.create_task(run_backup(application.bot))
+        BACKUP_RUNS.add(run)
+        run.add_done_callback(BACKUP_RUNS.discard)
+        await asyncio.shield(run)
+
+# Endless background loops. They are not started with application.create_task():
+# PTB does not track tasks created in post_init, and on_stop() must end them
+# before the application shuts down.
+WORKER_TASKS = set()
+
+def start_worker(coroutine) -> None:
+    WORKER_TASKS.add(asyncio.create_task(coroutine))
+
+async def on_startup(application: Application) -> None:
+    start_worker(backup_worker(application))
+    start_worker(user_context_cleanup_worker(application))
+
+async def on_stop(application: Application) -> None:
+    tasks = list(WORKER_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    WORKER_TASKS.clear()
+    await asyncio.gather(*BACKUP_RUNS, return_exceptions=True)
+
+# =====================================================================
+# Per-User Purchase History
+# =====================================================================
+# Purchases are rows in the purchases table. A cached user holds the last
+# PURCHASES_LOADED_DAYS of them as (epoch seconds, product id) tuples, in
+# time order, so window queries are a binary search plus a slice.
+PURCHASES_PAGE_SIZE = 20               # purchases per page in the admin history view
+PURCHASES_LOADED_DAYS = 30             # purchases read into a user's cached record
+
+def epoch_seconds(timestamp: datetime.datetime) -> int:
+    return int((timestamp - datetime.datetime(1970, 1, 1)).total_seconds())
+
+def from_epoch_seconds(seconds: int) -> datetime.datetime:
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+
+def parse_purchase_history(purchases: list) -> list:
+    history = []
+    for timestamp, product in purchases:
+        # Rows written before product ids hold ISO timestamps and product names.
+        if isinstance(timestamp, str):
+            timestamp = epoch_seconds(datetime.datetime.fromisoformat(timestamp))
+        if isinstance(product, str):
+            product = get_product_id(product)
+        history.append((timestamp, product))
+    history.sort(key=lambda entry: entry[0])
+    return history
+
+async def purchases_since(user_id: int, cutoff: datetime.datetime) -> list:
+    purchases = (await get_user(user_id)).purchases
+    start = bisect.bisect_left(purchases, epoch_seconds(cutoff), key=lambda entry: entry[0])
+    return purchases[start:]
+
+def format_purchase_page(user_id: int, purchases: list, page: int):
+    # Newest purchases come first; returns the message text and its keyboard.
+    pages = max(1, (len(purchases) + PURCHASES_PAGE_SIZE - 1) // PURCHASES_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    end = len(purchases) - page * PURCHASES_PAGE_SIZE
+    chunk = purchases[max(0, end - PURCHASES_PAGE_SIZE):end]
+    lines = [f"{from_epoch_seconds(timestamp):%Y-%m-%d %H:%M} | {PRODUCT_NAMES[product]}"
+             for timestamp, product in reversed(chunk)]
+    msg = (f"خریدهای اخیر (۷ روز) - {len(purchases)} خرید - صفحه {page + 1}/{pages}:\n" +
+           ("\n".join(lines) if lines else "هیچ خریدی ثبت نشده است."))
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ جدیدتر", callback_data=f"purchasespage_{user_id}_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("قدیمی‌تر ➡️", callback_data=f"purchasespage_{user_id}_{page + 1}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
+    return msg, InlineKeyboardMarkup(keyboard)
 
 # =====================================================================
 # Membership Check Function
@@ -259,7 +676,9 @@ async def banned_check_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    REGISTERED_USERS.add(user_id)
+    if user_id not in REGISTERED_USERS:
+        REGISTERED_USERS.add(user_id)
+        db.submit(SQL_INSERT_REGISTERED_USER, (user_id,))
     if not BOT_ACTIVE:
         await update.message.reply_text("ربات خاموش است❌")
         return
@@ -292,32 +711,32 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if product not in SERVICE_CODES or not SERVICE_CODES[product]:
         await query.edit_message_text(text="کد موجود نمی‌باشد❌", reply_markup=get_inline_main_menu())
         return
-    balance = USER_BALANCES.get(user_id, 0)
+    record = await get_user(user_id)
     price = PRODUCT_PRICES.get(product, 30000)
-    if balance < price:
+    if record.balance < price:
         await query.edit_message_text(text="موجودی شما کافی نیست❌", reply_markup=get_inline_main_menu())
         return
-    USER_BALANCES[user_id] = balance - price
-    now = datetime.datetime.utcnow().isoformat()
-    USER_RECENT_PURCHASES.setdefault(user_id, []).append((now, product))
-    USER_PURCHASED[user_id] = USER_PURCHASED.get(user_id, 0) + 1
+    record.balance -= price
+    entry = (epoch_seconds(datetime.datetime.utcnow()), get_product_id(product))
+    record.purchases.append(entry)
+    record.purchased += 1
+    db.submit(SQL_INSERT_PURCHASE, (user_id, *entry, price))
     code = SERVICE_CODES[product].pop(0)
+    db.submit(SQL_DELETE_FIRST_SERVICE_CODE, (product,))
+    await save_user(user_id)
     if not SERVICE_CODES[product]:
         await context.bot.send_message(chat_id=ADMIN_ID,
             text=f"❌کدهای سرویس {product} تمام شده‌اند؛ لطفاً کدها را شارژ کنید.")
     message = f"🛍کد تخفیف شما آماده شد 🤩\n\n🛍کد: {code}"
     await query.edit_message_text(text=message, reply_markup=get_inline_main_menu())
-    save_all_user_data()
 
 async def user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    balance = USER_BALANCES.get(user_id, 0)
-    charged = USER_CHARGED.get(user_id, 0)
-    purchased = USER_PURCHASED.get(user_id, 0)
+    record = await get_user(user_id)
     msg = (f"🪪 شناسه حساب : {user_id}\n"
-           f"💳 مبلغ شارژ شده تا الان : {charged}\n"
-           f"🌐 تعداد کدهای خریداری شده : {purchased}\n"
-           f"💰 موجودی شما : {balance}")
+           f"💳 مبلغ شارژ شده تا الان : {record.charged}\n"
+           f"🌐 تعداد کدهای خریداری شده : {record.purchased}\n"
+           f"💰 موجودی شما : {record.balance}")
     await update.message.reply_text(msg, reply_markup=get_user_profile_keyboard())
 
 async def charge_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -411,8 +830,10 @@ async def admin_receive_button_price(update: Update, context: ContextTypes.DEFAU
     PRODUCT_PRICES[button_name] = price
     SERVICE_CODES[button_name] = []
     SERVICE_FILE_PATH[button_name] = ""
+    await db.executebatch([(SQL_UPSERT_CATALOG, [(button_name, price)]),
+                           (SQL_DELETE_SERVICE_CODES, [(button_name,)]),
+                           (SQL_DELETE_SERVICE_FILE, [(button_name,)])])
     await update.message.reply_text(f"دکمه '{button_name}' با قیمت {price} اضافه شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 # =====================================================================
@@ -444,8 +865,10 @@ async def admin_remove_button_select(update: Update, context: ContextTypes.DEFAU
         del SERVICE_CODES[product]
     if product in SERVICE_FILE_PATH:
         del SERVICE_FILE_PATH[product]
+    await db.executebatch([(SQL_DELETE_CATALOG, [(product,)]),
+                           (SQL_DELETE_SERVICE_CODES, [(product,)]),
+                           (SQL_DELETE_SERVICE_FILE, [(product,)])])
     await query.edit_message_text(f"دکمه '{product}' حذف شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 # =====================================================================
@@ -468,21 +891,21 @@ async def admin_increase_select(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     product = query.data.split("_", 1)[1]
-    context.user_data["target_product"] = product
+    context.user_data["increase_product"] = product
     current_price = PRODUCT_PRICES.get(product, 0)
     await query.edit_message_text(f"نام محصول: {product}\nقیمت فعلی: {current_price}\nلطفاً قیمت جدید را وارد کنید:", reply_markup=get_inline_main_menu())
     return INCREASE_PRODUCT_INPUT
 
 async def admin_increase_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    product = context.user_data.get("target_product", "")
+    product = context.user_data.get("increase_product", "")
     text = update.message.text.strip()
     if not text.isdigit():
         await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید!")
         return INCREASE_PRODUCT_INPUT
     new_price = int(text)
     PRODUCT_PRICES[product] = new_price
+    await db.execute(SQL_UPSERT_CATALOG, (product, new_price))
     await update.message.reply_text(f"قیمت {product} به {new_price} تغییر یافت.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 # =====================================================================
@@ -505,21 +928,21 @@ async def admin_decrease_select(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     product = query.data.split("_", 1)[1]
-    context.user_data["target_product"] = product
+    context.user_data["decrease_product"] = product
     current_price = PRODUCT_PRICES.get(product, 0)
     await query.edit_message_text(f"نام محصول: {product}\nقیمت فعلی: {current_price}\nلطفاً قیمت جدید را وارد کنید:", reply_markup=get_inline_main_menu())
     return DECREASE_PRODUCT_INPUT
 
 async def admin_decrease_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    product = context.user_data.get("target_product", "")
+    product = context.user_data.get("decrease_product", "")
     text = update.message.text.strip()
     if not text.isdigit():
         await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید!")
         return DECREASE_PRODUCT_INPUT
     new_price = int(text)
     PRODUCT_PRICES[product] = new_price
+    await db.execute(SQL_UPSERT_CATALOG, (product, new_price))
     await update.message.reply_text(f"قیمت {product} به {new_price} تغییر یافت.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 # =====================================================================
@@ -558,8 +981,9 @@ async def admin_delete_code_input(update: Update, context: ContextTypes.DEFAULT_
     if input_path == stored_path:
         SERVICE_CODES[product] = []
         del SERVICE_FILE_PATH[product]
+        await db.executebatch([(SQL_DELETE_SERVICE_CODES, [(product,)]),
+                               (SQL_DELETE_SERVICE_FILE, [(product,)])])
         await update.message.reply_text("کدهای سرویس حذف شدند✅", reply_markup=get_admin_panel_keyboard())
-        save_all_user_data()
     else:
         await update.message.reply_text("مسیر وارد شده مطابقت ندارد.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
@@ -593,16 +1017,17 @@ async def admin_add_credit_userid(update: Update, context: ContextTypes.DEFAULT_
         return ADMIN_ADD_USERID
     target_id = int(text)
     amount = context.user_data.get("admin_credit_amount", 0)
-    new_balance = USER_BALANCES.get(target_id, 0) + amount
-    USER_BALANCES[target_id] = new_balance
-    USER_CHARGED[target_id] = USER_CHARGED.get(target_id, 0) + amount
+    record = await get_user(target_id)
+    record.balance += amount
+    record.charged += amount
+    await save_user(target_id)
+    new_balance = record.balance
     try:
         await context.bot.send_message(chat_id=target_id,
             text=f"موجودی شما به مبلغ {amount} شارژ شد. موجودی جدید: {new_balance}")
     except Exception as e:
         await update.message.reply_text(f"خطا در ارسال پیام به کاربر: {e}")
     await update.message.reply_text("اعتبار کاربر اضافه شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_subtract_credit_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -631,15 +1056,16 @@ async def admin_subtract_credit_userid(update: Update, context: ContextTypes.DEF
         return ADMIN_SUB_USERID
     target_id = int(text)
     amount = context.user_data.get("admin_sub_amount", 0)
-    new_balance = USER_BALANCES.get(target_id, 0) - amount
-    USER_BALANCES[target_id] = new_balance
+    record = await get_user(target_id)
+    record.balance -= amount
+    await save_user(target_id)
+    new_balance = record.balance
     try:
         await context.bot.send_message(chat_id=target_id,
             text=f"موجودی شما به مبلغ {amount} کاهش یافت. موجودی جدید: {new_balance}")
     except Exception as e:
         await update.message.reply_text(f"خطا در ارسال پیام به کاربر: {e}")
     await update.message.reply_text("اعتبار کسر شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_unblock_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -659,12 +1085,12 @@ async def admin_unblock_userid(update: Update, context: ContextTypes.DEFAULT_TYP
     target_id = int(text)
     if BANNED_USERS.get(target_id, False):
         BANNED_USERS[target_id] = False
+        await db.execute(SQL_DELETE_BANNED_USER, (target_id,))
         try:
             await context.bot.send_message(chat_id=target_id, text="کاربر آزاد شدید ✅")
         except Exception as e:
             await update.message.reply_text(f"خطا: {e}")
         await update.message.reply_text("کاربر آزاد شد.", reply_markup=get_admin_panel_keyboard())
-        save_all_user_data()
     else:
         await update.message.reply_text("کاربر مسدود نیست.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
@@ -685,12 +1111,12 @@ async def admin_ban_userid(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ADMIN_BAN_USERID
     target_id = int(text)
     BANNED_USERS[target_id] = True
+    await db.execute(SQL_INSERT_BANNED_USER, (target_id,))
     try:
         await context.bot.send_message(chat_id=target_id, text="شما بن شده‌اید ❌")
     except Exception as e:
         await update.message.reply_text(f"خطا: {e}")
     await update.message.reply_text("کاربر بن شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -741,13 +1167,11 @@ async def admin_balance_userid(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("لطفاً آیدی عددی معتبر وارد کنید!")
         return ADMIN_BALANCE_USERID
     target_id = int(text)
-    charged = USER_CHARGED.get(target_id, 0)
-    balance = USER_BALANCES.get(target_id, 0)
-    purchased = USER_PURCHASED.get(target_id, 0)
+    record = await get_user(target_id)
     msg = (f"آیدی کاربر: {target_id}\n"
-           f"مبلغ شارژ شده: {charged}\n"
-           f"موجودی فعلی: {balance}\n"
-           f"تعداد خریدها: {purchased}")
+           f"مبلغ شارژ شده: {record.charged}\n"
+           f"موجودی فعلی: {record.balance}\n"
+           f"تعداد خریدها: {record.purchased}")
     await update.message.reply_text(msg, reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
 
@@ -766,14 +1190,21 @@ async def admin_recent_purchases_userid(update: Update, context: ContextTypes.DE
         await update.message.reply_text("لطفاً آیدی عددی معتبر وارد کنید!")
         return ADMIN_RECENT_PURCHASES_USERID
     target_id = int(text)
-    now = datetime.datetime.utcnow()
-    week_ago = now - datetime.timedelta(days=7)
-    purchases = USER_RECENT_PURCHASES.get(target_id, [])
-    recent = [str(product) for (timestamp, product) in purchases if datetime.datetime.fromisoformat(timestamp) >= week_ago]
-    msg = f"خریدهای اخیر (۷ روز):\n" + ("\n".join(recent) if recent else "هیچ خریدی ثبت نشده است.")
-    await update.message.reply_text(msg, reply_markup=get_admin_panel_keyboard())
+    week_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+    msg, keyboard = format_purchase_page(target_id, await purchases_since(target_id, week_ago), 0)
+    await update.message.reply_text(msg, reply_markup=keyboard)
     return ConversationHandler.END
 
+async def admin_recent_purchases_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        return
+    _, target_id, page = query.data.split("_")
+    week_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+    msg, keyboard = format_purchase_page(int(target_id), await purchases_since(int(target_id), week_ago), int(page))
+    await query.edit_message_text(msg, reply_markup=keyboard)
+
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -795,15 +1226,13 @@ async def admin_broadcast_message(update: Update, context: ContextTypes.DEFAULT_
 
 # ------------------- Handlers for Bot Control Buttons -------------------
 async def admin_turn_off_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global BOT_ACTIVE
-    BOT_ACTIVE = False
+    await set_bot_active(False)
     query = update.callback_query
     await query.answer()
     await query.edit_message_text("ربات خاموش شد❌", reply_markup=get_admin_panel_keyboard())
 
 async def admin_turn_on_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global BOT_ACTIVE
-    BOT_ACTIVE = True
+    await set_bot_active(True)
     query = update.callback_query
     await query.answer()
     await query.edit_message_text("ربات روشن شد✅", reply_markup=get_admin_panel_keyboard())
@@ -813,27 +1242,20 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await query.answer()
     now = datetime.datetime.utcnow()
     week_ago = now - datetime.timedelta(days=7)
-    total_codes_sold = 0
-    total_charge = 0
-    highest_charge = 0
-    top_buyer_id = None
-    top_buyer_count = 0
-    for user, purchases in USER_RECENT_PURCHASES.items():
-        count = sum(1 for (timestamp, _) in purchases if datetime.datetime.fromisoformat(timestamp) >= week_ago)
-        total_codes_sold += count
-        if count > top_buyer_count:
-            top_buyer_count = count
-            top_buyer_id = user
-    for user, charge in USER_CHARGED.items():
-        total_charge += charge
-        if charge > highest_charge:
-            highest_charge = charge
-    total_codes_available = 15  # Placeholder value
+    # Read from SQLite rather than the cache, which only holds recently active users.
+    cutoff = epoch_seconds(week_ago)
+    (total_codes_sold,) = await db.fetchone(SQL_SALES_SINCE, (cutoff,))
+    top_buyer_id, top_buyer_count = await db.fetchone(SQL_TOP_BUYER_SINCE, (cutoff,)) or (None, 0)
+    total_charge, highest_charge = await db.fetchone(SQL_CHARGE_TOTALS)
+    # SERVICE_CODES mirrors the service_codes table, so the counts need no query.
+    codes_available = {product: len(SERVICE_CODES.get(product, [])) for product in PRODUCT_PRICES}
     stats_msg = (
-        f"🎟کد های فروش رفته در هفته اخیر: {total_codes_sold}/{total_codes_available}\n"
+        f"🎟کد های فروش رفته در هفته اخیر: {total_codes_sold}/{sum(codes_available.values())}\n"
         f"💳کل مبلغ شارژ شده در این هفته: {total_charge}\n"
         f"🥇بیشترین مبلغ شارژ شده در هفته اخیر: {highest_charge}\n"
-        f"🔹بیشترین خریدار کد: {top_buyer_id} | تعداد خرید: {top_buyer_count}"
+        f"🔹بیشترین خریدار کد: {top_buyer_id} | تعداد خرید: {top_buyer_count}\n\n"
+        "📦موجودی محصولات:\n"
+        + "\n".join(f"{product}: {count}" for product, count in codes_available.items())
     )
     await query.edit_message_text(stats_msg, reply_markup=get_admin_panel_keyboard())
 
@@ -883,13 +1305,26 @@ async def add_code_filepath_handler(update: Update, context: ContextTypes.DEFAUL
         return ADD_CODE_FILEPATH
     SERVICE_CODES[service] = codes
     SERVICE_FILE_PATH[service] = file_path
+    await db.executebatch([(SQL_DELETE_SERVICE_CODES, [(service,)]),
+                           (SQL_INSERT_SERVICE_CODE, [(service, code) for code in codes]),
+                           (SQL_UPSERT_SERVICE_FILE, [(service, file_path)])])
     await update.message.reply_text("کدها و مسیر فایل ثبت شدند✅", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
+    return ConversationHandler.END
+
+async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("عملیات لغو شد.")
     return ConversationHandler.END
 
 # =====================================================================
 # New: Panel Handler for /panel Command (Admin Only)
 # =====================================================================
+async def admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("شما به این بخش دسترسی ندارید.")
+        return
+    await update.message.reply_text("⏳پشتیبان‌گیری در پس‌زمینه شروع شد...")
+    context.application.create_task(run_backup(context.bot, update.effective_chat.id))
+
 async def panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.from_user.id == ADMIN_ID:
         await update.message.reply_text("پنل مدیریت", reply_markup=get_admin_panel_keyboard())
@@ -900,10 +1335,20 @@ async def panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 # Main Function - Register Handlers and Run the Bot
 # =====================================================================
 async def main():
-    init_db()
-    load_user_data()
-    application = Application.builder().token("YOUR_TELEGRAM_BOT_TOKEN_HERE").build()
+    # User rows are not read up front; see get_user().
+    await init_db()
+    application = (
+        Application.builder()
+        .token("YOUR_TELEGRAM_BOT_TOKEN_HERE")
+        .persistence(SQLitePersistence(db, CONVERSATION_PERSIST_INTERVAL))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .build()
+    )
     
+    # Sees every update before the handlers below; feeds user_context_cleanup_worker().
+    application.add_handler(TypeHandler(Update, note_user_activity), group=-1)
+
     # ---------------- User Handlers ----------------
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.Regex("^خرید محصول 🛍$"), buy_product))
@@ -917,139 +1362,190 @@ async def main():
     
     # ---------------- Admin Panel Command ----------------
     application.add_handler(CommandHandler("panel", panel_handler))
+    application.add_handler(CommandHandler("backup", admin_backup))
     
     # ---------------- Conversation Handlers for Admin ----------------
     admin_add_code_conv = ConversationHandler(
+        name="admin_add_code",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_add_code_entry, pattern="^admin_add_code$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("addcode_service")],
             ADD_CODE_SERVICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_service_name)],
             ADD_CODE_FILEPATH: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_code_filepath_handler)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_add_code_conv)
     
     admin_add_credit_conv = ConversationHandler(
+        name="admin_add_credit",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_add_credit_start, pattern="^admin_add_credit$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("admin_credit_amount")],
             ADMIN_ADD_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_credit_amount)],
             ADMIN_ADD_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_credit_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_add_credit_conv)
     
     admin_subtract_credit_conv = ConversationHandler(
+        name="admin_subtract_credit",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_subtract_credit_start, pattern="^admin_subtract_credit$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("admin_sub_amount")],
             ADMIN_SUB_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_subtract_credit_amount)],
             ADMIN_SUB_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_subtract_credit_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_subtract_credit_conv)
     
     admin_unblock_conv = ConversationHandler(
+        name="admin_unblock",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_unblock_start, pattern="^admin_unblock$")],
         states={
             ADMIN_UNBLOCK_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_unblock_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_unblock_conv)
     
     admin_ban_conv = ConversationHandler(
+        name="admin_ban",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_ban_start, pattern="^admin_ban$")],
         states={
             ADMIN_BAN_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_ban_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_ban_conv)
     
     admin_message_conv = ConversationHandler(
+        name="admin_message",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_message_start, pattern="^admin_message$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("admin_target")],
             ADMIN_MESSAGE_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_userid)],
             ADMIN_MESSAGE_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_text)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_message_conv)
     
     admin_balance_conv = ConversationHandler(
+        name="admin_balance",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_balance_start, pattern="^admin_balance$")],
         states={
             ADMIN_BALANCE_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_balance_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_balance_conv)
     
     admin_recent_purchases_conv = ConversationHandler(
+        name="admin_recent_purchases",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_recent_purchases_start, pattern="^admin_recent_purchases$")],
         states={
             ADMIN_RECENT_PURCHASES_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_recent_purchases_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_recent_purchases_conv)
     
     admin_broadcast_conv = ConversationHandler(
+        name="admin_broadcast",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_broadcast_start, pattern="^admin_broadcast$")],
         states={
             ADMIN_BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_message)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_broadcast_conv)
     
     admin_increase_conv = ConversationHandler(
+        name="admin_increase",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_increase_start, pattern="^admin_increase_price$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("increase_product")],
             INCREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_increase_select, pattern="^increase_")],
             INCREASE_PRODUCT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_increase_input)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_increase_conv)
     
     admin_decrease_conv = ConversationHandler(
+        name="admin_decrease",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_decrease_start, pattern="^admin_decrease_price$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("decrease_product")],
             DECREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_decrease_select, pattern="^decrease_")],
             DECREASE_PRODUCT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_decrease_input)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_decrease_conv)
     
     admin_delete_code_conv = ConversationHandler(
+        name="admin_delete_code",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_delete_code_start, pattern="^admin_delete_code$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("delete_service")],
             ADMIN_DELETE_CODE_SERVICE: [CallbackQueryHandler(admin_delete_code_select, pattern="^delete_")],
             ADMIN_DELETE_CODE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_delete_code_input)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_delete_code_conv)
     
     admin_add_button_conv = ConversationHandler(
+        name="admin_add_button",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_add_button_start, pattern="^admin_add_button$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("new_button_name")],
             ADD_BUTTON_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_button_name)],
             ADD_BUTTON_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_button_price)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_add_button_conv)
     
     admin_remove_button_conv = ConversationHandler(
+        name="admin_remove_button",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_remove_button_start, pattern="^admin_remove_button$")],
         states={
             REMOVE_BUTTON_SELECT: [CallbackQueryHandler(admin_remove_button_select, pattern="^remove_")]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_remove_button_conv)
     
@@ -1057,6 +1553,7 @@ async def main():
     application.add_handler(CallbackQueryHandler(admin_turn_on_bot, pattern="^admin_turn_on_bot$"))
     application.add_handler(CallbackQueryHandler(admin_turn_off_bot, pattern="^admin_turn_off_bot$"))
     application.add_handler(CallbackQueryHandler(admin_stats, pattern="^admin_stats$"))
+    application.add_handler(CallbackQueryHandler(admin_recent_purchases_page, pattern="^purchasespage_"))
     
     application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
     
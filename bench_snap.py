@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Times saving and loading snap.py's user data with synthetic users, and with
+# --backup, how much an online backup delays purchases handled meanwhile.
+# Usage: python bench_snap.py [--backup] [user counts...]   (default: 100000 1000000)
+import asyncio
+import os
+import sys
+import time
+import random
+import tempfile
+from collections import deque
+
+import snap
+
+def make_users(count: int) -> dict:
+    rng = random.Random(count)
+    now = int(time.time())
+    users = {}
+    for user_id in range(10**9, 10**9 + count):
+        purchases = None
+        # Roughly a third of users have bought something recently.
+        if rng.random() < 0.3:
+            purchases = deque(sorted((now - rng.randrange(86400 * snap.PURCHASE_HOT_DAYS), 0, 30000)
+                                     for _ in range(rng.randint(1, 5))),
+                              maxlen=snap.PURCHASE_HOT_MAX_ENTRIES)
+        users[user_id] = snap.UserRecord(rng.randrange(200000), rng.randrange(10**6), rng.randint(0, 50), purchases)
+    return users
+
+def timed(function) -> float:
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+def bench(count: int) -> None:
+    users = make_users(count)
+    for fmt, compress in (("json", False), ("binary", False), ("binary", True)):
+        snap.USER_DATA_FORMAT = fmt
+        snap.SNAPSHOT_COMPRESS = compress
+        snap.USERS = users
+        save = timed(snap.save_user_data)
+        path = snap.DATA_FILE if fmt == "json" else snap.SNAPSHOT_FILE
+        size = os.path.getsize(path)
+        load = timed(snap.load_user_data)
+        assert len(snap.USERS) == count
+        label = fmt + (" + gzip" if compress else "")
+        print(f"{count:>9} users  {label:<14} save {save:6.2f}s  load {load:6.2f}s  {size / 2**20:8.1f} MiB")
+        os.remove(path)
+
+async def purchase_delays(until: asyncio.Future) -> list:
+    # Simulated buyers: one balance change every 5 ms; records how late each one ran.
+    delays = []
+    user_ids = list(snap.USERS)
+    while not until.done():
+        started = time.perf_counter()
+        await asyncio.sleep(0.005)
+        user_id = random.choice(user_ids)
+        snap.set_user_balance(user_id, snap.get_user(user_id).balance + 1)
+        delays.append(time.perf_counter() - started - 0.005)
+    return delays
+
+def describe_delays(delays: list) -> str:
+    delays = sorted(delays)
+    return (f"p50 {delays[len(delays) // 2] * 1000:5.1f}ms  p99 {delays[int(len(delays) * 0.99)] * 1000:5.1f}ms  "
+            f"max {delays[-1] * 1000:6.1f}ms")
+
+async def bench_backup(count: int) -> None:
+    snap.USERS = make_users(count)
+    idle = asyncio.get_running_loop().create_future()
+    asyncio.get_running_loop().call_later(2, idle.set_result, None)
+    baseline = await purchase_delays(idle)
+    backup = asyncio.ensure_future(snap.backup_user_data())
+    during = await purchase_delays(backup)
+    result = backup.result()
+    print(f"{count:>9} users  backup capture {result['capture']:5.2f}s  write {result['write']:5.2f}s  "
+          f"{result['bytes'] / 2**20:6.1f} MiB  longest pause {result['pause'] * 1000:.0f}ms")
+    print(f"{'':>16}purchase delay idle:          {describe_delays(baseline)}")
+    print(f"{'':>16}purchase delay during backup: {describe_delays(during)}")
+
+def main():
+    args = sys.argv[1:]
+    backup = "--backup" in args
+    counts = [int(arg) for arg in args if arg != "--backup"] or [100000, 1000000]
+    os.chdir(tempfile.mkdtemp(prefix="bench_snap_"))
+    snap.load_sales_series()
+    snap.sales_product_id(next(iter(snap.PRODUCT_PRICES)))
+    for count in counts:
+        if backup:
+            asyncio.run(bench_backup(count))
+        else:
+            bench(count)
+
+if __name__ == "__main__":
+    main()
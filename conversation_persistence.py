@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# PTB persistence for admin conversation states and context.user_data,
+# shared by snap.py and Forosh_code_food.py so a restart does not strand a
+# half-finished flow. PTB hands over the users and conversations touched
+# since its last run every update_interval seconds; each entry is compared
+# with what was last written, and only the entries that changed are
+# written, together in one transaction. One row per entry; values are JSON.
+#
+# The storage backend is any object with async fetchall(sql, params) and
+# executebatch(steps): Forosh passes its Database, snap.py a
+# ConversationDatabase on its own file.
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# =====================================================================
+# Tables
+# =====================================================================
+SQL_CREATE_CONVERSATIONS = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (name, key)
+    )
+"""
+SQL_CREATE_USER_CONTEXT = """
+    CREATE TABLE IF NOT EXISTS user_context (
+        user_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (user_id, key)
+    )
+"""
+SQL_SELECT_CONVERSATIONS = "SELECT key, state FROM conversations WHERE name = ?"
+SQL_UPSERT_CONVERSATION = """
+    INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+    ON CONFLICT (name, key) DO UPDATE SET state = excluded.state
+"""
+SQL_DELETE_CONVERSATION = "DELETE FROM conversations WHERE name = ? AND key = ?"
+SQL_SELECT_USER_CONTEXT = "SELECT user_id, key, value FROM user_context"
+SQL_UPSERT_USER_CONTEXT = """
+    INSERT INTO user_context (user_id, key, value) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value
+"""
+SQL_DELETE_USER_CONTEXT = "DELETE FROM user_context WHERE user_id = ? AND key = ?"
+SQL_DELETE_USER_CONTEXT_ALL = "DELETE FROM user_context WHERE user_id = ?"
+
+# =====================================================================
+# Standalone Backend
+# =====================================================================
+class ConversationDatabase:
+    # A file of its own for bots whose other data is not in SQLite.
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        # One thread owns the connection, so reads and writes stay in order.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversations")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            for sql in (SQL_CREATE_CONVERSATIONS, SQL_CREATE_USER_CONTEXT):
+                self.connection.execute(sql)
+        return self.connection
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        return self._connect().execute(sql, params).fetchall()
+
+    def _executebatch(self, steps: list) -> None:
+        connection = self._connect()
+        with connection:
+            for sql, rows in steps:
+                connection.executemany(sql, rows)
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._fetchall, sql, params)
+
+    async def executebatch(self, steps: list) -> None:
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._executebatch, steps)
+
+# =====================================================================
+# Persistence
+# =====================================================================
+class SQLitePersistence(BasePersistence):
+    def __init__(self, database, update_interval: float):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.database = database
+        self.user_entries = {}         # user_id -> {key: JSON text as last written}
+        self.conversation_states = {}  # (name, JSON key) -> JSON state as last written
+        self.pending = {}              # entry -> (sql, params) waiting for the next write
+        self.write_task = None
+        self.write_lock = asyncio.Lock()
+
+    def stage(self, entry: tuple, sql: str, params: tuple) -> None:
+        # A later change to the same entry replaces the queued one.
+        self.pending[entry] = (sql, params)
+        if self.write_task is None:
+            self.write_task = asyncio.create_task(self.write_soon())
+
+    async def write_soon(self) -> None:
+        # PTB runs its updates for one interval concurrently; yielding once
+        # lets them all stage before the batch is written.
+        await asyncio.sleep(0)
+        self.write_task = None
+        await self.write_pending()
+
+    async def write_pending(self) -> None:
+        # The lock lets flush() wait for a batch that is already being written.
+        async with self.write_lock:
+            await self.write_batch()
+
+    async def write_batch(self) -> None:
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await self.database.executebatch([(sql, [params]) for sql, params in pending.values()])
+        except Exception:
+            logger.exception("Could not save conversation state")
+            # The cached entries already say these writes happened, so nothing
+            # would stage them again; a lost DELETE would bring a finished flow
+            # back after a restart. They are queued again, ahead of anything
+            # staged since, and go out with the next write or flush().
+            restored = {entry: step for entry, step in pending.items() if entry not in self.pending}
+            restored.update(self.pending)
+            self.pending = restored
+
+    async def get_user_data(self) -> dict:
+        user_data = {}
+        for user_id, key, value in await self.database.fetchall(SQL_SELECT_USER_CONTEXT):
+            self.user_entries.setdefault(user_id, {})[key] = value
+            user_data.setdefault(user_id, {})[key] = json.loads(value)
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        written = self.user_entries.setdefault(user_id, {})
+        for key, value in data.items():
+            try:
+                text = json.dumps(value, ensure_ascii=False)
+            except TypeError:
+                logger.warning(f"user_data[{key!r}] of user {user_id} is not JSON; kept in memory only")
+                continue
+            if written.get(key) != text:
+                written[key] = text
+                self.stage(("user", user_id, key), SQL_UPSERT_USER_CONTEXT, (user_id, key, text))
+        for key in [key for key in written if key not in data]:
+            del written[key]
+            self.stage(("user", user_id, key), SQL_DELETE_USER_CONTEXT, (user_id, key))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        written = self.user_entries.pop(user_id, None)
+        if not written:
+            return
+        for key in written:
+            self.pending.pop(("user", user_id, key), None)
+        self.stage(("user", user_id, None), SQL_DELETE_USER_CONTEXT_ALL, (user_id,))
+
+    async def get_conversations(self, name: str) -> dict:
+        conversations = {}
+        for key, state in await self.database.fetchall(SQL_SELECT_CONVERSATIONS, (name,)):
+            self.conversation_states[(name, key)] = state
+            conversations[tuple(json.loads(key))] = json.loads(state)
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        key_text = json.dumps(list(key))
+        if new_state is None:
+            if self.conversation_states.pop((name, key_text), None) is not None:
+                self.stage(("conversation", name, key_text), SQL_DELETE_CONVERSATION, (name, key_text))
+            return
+        state = json.dumps(new_state)
+        if self.conversation_states.get((name, key_text)) != state:
+            self.conversation_states[(name, key_text)] = state
+            self.stage(("conversation", name, key_text), SQL_UPSERT_CONVERSATION, (name, key_text, state))
+
+    async def flush(self) -> None:
+        await self.write_pending()
+
+    # Only user_data and conversations are stored.
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
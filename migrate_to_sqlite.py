@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# Copies snap.py's users, purchases and bot state (catalog, unsold codes,
+# service files, bans, on/off switch and registered users) into the SQLite
+# database used by Forosh_code_food.py. user_data.json is parsed one user at a time, so memory
+# stays flat however large the file is; the binary user_data.snap is read
+# column by column, and a sharded save (USER_SHARDS > 0) one shard at a time.
+# Checksums written by snap.py are verified before anything is copied.
+# snap.py can keep running while this copies its last save.
+#
+# Usage: python migrate_to_sqlite.py [user_data.json|user_data.snap|user_shards] [user_data.db] [sales/products.json]
+# registered_users.log and sales/products.json are read from the directory
+# snap.py ran in, next to the save.
+import io
+import json
+import os
+import sqlite3
+import struct
+import sys
+import time
+import zlib
+import datetime
+
+import Forosh_code_food as forosh
+
+BATCH_USERS = 50000                    # users per transaction
+READ_CHUNK = 1 << 20                   # characters read from the JSON file at a time
+PROGRESS_INTERVAL = 2                  # seconds between progress lines
+LEGACY_FIELDS = {"USER_BALANCES": "balance", "USER_CHARGED": "charged", "USER_PURCHASED": "purchased"}
+
+# =====================================================================
+# Incremental JSON Reader
+# =====================================================================
+class JsonStream:
+    # Walks a JSON document value by value; only the current value and one
+    # read chunk are held in memory.
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self) -> None:
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(READ_CHUNK)
+        if not chunk:
+            self.eof = True
+        self.buffer += chunk
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ""
+            self.fill()
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r}, found {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+            # A number that ends exactly at the buffer's end may continue in the next chunk.
+            if end == len(self.buffer) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+    def keys(self):
+        # Yields each key of the object at the current position; the caller
+        # must consume the key's value before asking for the next one.
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return
+
+    def skip(self) -> None:
+        char = self.peek()
+        if char == "{":
+            for _ in self.keys():
+                self.skip()
+        elif char == "[":
+            self.pos += 1
+            while self.peek() != "]":
+                self.skip()
+                if self.peek() == ",":
+                    self.pos += 1
+            self.pos += 1
+        else:
+            self.value()
+
+# =====================================================================
+# Source Readers
+# =====================================================================
+# Both readers yield ("user", user_id, balance, charged, purchased, purchases)
+# for the compact formats, or ("field", column, user_id, value) /
+# ("purchases", user_id, purchases) for the legacy four-dict layout, and
+# ("state", bot_state) when the file carries snap.py's BOT_STATE.
+def verify_json_checksum(path: str) -> None:
+    # Same check as snap.read_checksummed_json, streamed so the file is never held whole.
+    import snap
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.seek(max(0, size - 64))
+        tail = f.read()
+        offset = tail.rfind(snap.JSON_CHECKSUM_PREFIX)
+        if offset < 0:
+            # Saved before checksums were added.
+            return
+        body_length = size - len(tail) + offset
+        expected = int(tail[offset + len(snap.JSON_CHECKSUM_PREFIX):], 16)
+        f.seek(0)
+        checksum = 0
+        while f.tell() < body_length:
+            checksum = zlib.crc32(f.read(min(READ_CHUNK, body_length - f.tell())), checksum)
+    if checksum != expected:
+        raise ValueError(f"{path} failed its checksum")
+
+def iter_json_source(path: str, progress):
+    verify_json_checksum(path)
+    with open(path, "rb") as raw:
+        stream = JsonStream(io.TextIOWrapper(raw, encoding="utf-8"))
+        for key in stream.keys():
+            if key == "USERS":
+                for user_id in stream.keys():
+                    balance, charged, purchased, purchases = stream.value()
+                    yield ("user", int(user_id), balance, charged, purchased, purchases)
+                    progress(raw.tell())
+            elif key in LEGACY_FIELDS:
+                for user_id in stream.keys():
+                    yield ("field", LEGACY_FIELDS[key], int(user_id), stream.value())
+                    progress(raw.tell())
+            elif key == "USER_RECENT_PURCHASES":
+                for user_id in stream.keys():
+                    yield ("purchases", int(user_id), stream.value())
+                    progress(raw.tell())
+            elif key == "BOT_STATE":
+                yield ("state", stream.value())
+            else:
+                stream.skip()
+
+def iter_snapshot_users(columns: list):
+    user_ids, balances, charged, purchased, counts, timestamps, products, prices = columns
+    start = 0
+    for row, count in enumerate(counts):
+        end = start + count
+        purchases = [(timestamp, product, price if price >= 0 else None)
+                     for timestamp, product, price in zip(timestamps[start:end], products[start:end], prices[start:end])]
+        start = end
+        yield ("user", user_ids[row], balances[row], charged[row], purchased[row], purchases)
+
+def iter_snapshot_source(path: str, progress):
+    import snap
+    # read_user_snapshot checks the CRC trailer before returning any column.
+    columns, state = snap.read_user_snapshot(path)
+    user_count = len(columns[0])
+    for row, item in enumerate(iter_snapshot_users(columns)):
+        yield item
+        progress(row + 1, user_count)
+    if "BOT_STATE" in state:
+        yield ("state", state["BOT_STATE"])
+
+def iter_sharded_source(directory: str, progress):
+    # state.snap names the shard count of the last complete save; files of
+    # any other count are leftovers of a resharding.
+    import snap
+    _, state = snap.read_user_snapshot(os.path.join(directory, os.path.basename(snap.user_shard_state_path())))
+    shard_count = state["USER_SHARDS"]
+    for shard in range(shard_count):
+        path = os.path.join(directory, os.path.basename(snap.user_shard_path(shard, shard_count)))
+        columns, _ = snap.read_user_snapshot(path)
+        yield from iter_snapshot_users(columns)
+        progress(shard + 1, shard_count)
+    if "BOT_STATE" in state:
+        yield ("state", state["BOT_STATE"])
+
+def read_registered_users(path: str) -> list:
+    # snap.py appends one id per line; a line cut short by a crash has no newline.
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return sorted({int(line) for line in f if line.endswith("\n")})
+    except FileNotFoundError:
+        return []
+
+# =====================================================================
+# Migration
+# =====================================================================
+class Migration:
+    def __init__(self, connection: sqlite3.Connection, snap_product_names: list):
+        self.connection = connection
+        self.snap_product_names = snap_product_names
+        self.product_ids = {name: product_id for product_id, name in connection.execute(forosh.SQL_SELECT_PRODUCTS)}
+        self.users = []
+        self.purchases = []
+        self.fields = {field: [] for field in LEGACY_FIELDS.values()}
+        self.counts = {"users": 0, "purchases": 0, **{field: 0 for field in LEGACY_FIELDS.values()}}
+        self.pending = 0
+        self.bot_state = None
+
+    def product_id(self, product) -> int:
+        # snap.py stores sales-series ids (sales/products.json); older files store names.
+        if isinstance(product, int) and not 0 <= product < len(self.snap_product_names):
+            raise ValueError(f"product id {product} has no name in products.json")
+        name = self.snap_product_names[product] if isinstance(product, int) else product
+        product_id = self.product_ids.get(name)
+        if product_id is None:
+            product_id = self.product_ids[name] = len(self.product_ids)
+            self.connection.execute(forosh.SQL_INSERT_PRODUCT, (product_id, name))
+        return product_id
+
+    def add_purchases(self, user_id: int, purchases: list) -> None:
+        for entry in purchases:
+            timestamp = entry[0]
+            if isinstance(timestamp, str):
+                timestamp = forosh.epoch_seconds(datetime.datetime.fromisoformat(timestamp))
+            price = entry[2] if len(entry) > 2 else None
+            self.purchases.append((user_id, timestamp, self.product_id(entry[1]), price))
+        self.counts["purchases"] += len(purchases)
+
+    def add(self, item: tuple) -> None:
+        kind = item[0]
+        if kind == "user":
+            _, user_id, balance, charged, purchased, purchases = item
+            self.users.append((user_id, balance, charged, purchased))
+            self.counts["users"] += 1
+            self.add_purchases(user_id, purchases or ())
+        elif kind == "state":
+            self.bot_state = item[1]
+            return
+        elif kind == "field":
+            _, field, user_id, value = item
+            self.fields[field].append((user_id, value))
+            self.counts[field] += 1
+        else:
+            _, user_id, purchases = item
+            self.add_purchases(user_id, purchases or ())
+        self.pending += 1
+        if self.pending >= BATCH_USERS:
+            self.flush()
+
+    def flush(self) -> None:
+        self.connection.executemany(forosh.SQL_UPSERT_USER, self.users)
+        for field, rows in self.fields.items():
+            self.connection.executemany(
+                f"INSERT INTO users (user_id, {field}) VALUES (?, ?) "
+                f"ON CONFLICT (user_id) DO UPDATE SET {field} = excluded.{field}", rows)
+            rows.clear()
+        self.connection.executemany(forosh.SQL_INSERT_PURCHASE, self.purchases)
+        self.connection.commit()
+        self.users.clear()
+        self.purchases.clear()
+        self.pending = 0
+
+    def copy_bot_state(self, registered_users: list) -> dict:
+        # Files saved before snap.py kept its bot state start from Forosh's built-in catalog.
+        state = self.bot_state or {"PRODUCT_PRICES": forosh.PRODUCT_PRICES}
+        codes = [(product, code) for product, product_codes in state.get("SERVICE_CODES", {}).items()
+                 for code in product_codes]
+        banned = [(user_id,) for user_id in state.get("BANNED_USERS", [])]
+        self.connection.executemany(forosh.SQL_UPSERT_CATALOG, list(state["PRODUCT_PRICES"].items()))
+        self.connection.executemany(forosh.SQL_INSERT_SERVICE_CODE, codes)
+        self.connection.executemany(forosh.SQL_UPSERT_SERVICE_FILE, list(state.get("SERVICE_FILE_PATH", {}).items()))
+        self.connection.executemany(forosh.SQL_INSERT_BANNED_USER, banned)
+        self.connection.executemany(forosh.SQL_INSERT_REGISTERED_USER, [(user_id,) for user_id in registered_users])
+        if "BOT_ACTIVE" in state:
+            self.connection.execute(forosh.SQL_UPSERT_SETTING, ("bot_active", "1" if state["BOT_ACTIVE"] else "0"))
+        return {"products": len(state["PRODUCT_PRICES"]), "codes": len(codes), "banned": len(banned),
+                "registered": len(registered_users)}
+
+    def verify(self) -> list:
+        errors = []
+        (purchases,) = self.connection.execute("SELECT COUNT(*) FROM purchases").fetchone()
+        if purchases != self.counts["purchases"]:
+            errors.append(f"purchases: read {self.counts['purchases']}, table has {purchases}")
+        if self.counts["users"]:
+            (users,) = self.connection.execute("SELECT COUNT(*) FROM users").fetchone()
+            if users != self.counts["users"]:
+                errors.append(f"users: read {self.counts['users']}, table has {users}")
+        for field in LEGACY_FIELDS.values():
+            if self.counts[field]:
+                (rows,) = self.connection.execute(f"SELECT COUNT({field}) FROM users").fetchone()
+                if rows != self.counts[field]:
+                    errors.append(f"{field}: read {self.counts[field]}, table has {rows}")
+        return errors
+
+def open_target(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # Nothing reads the new database until the copy is verified.
+    connection.execute("PRAGMA synchronous=OFF")
+    for sql in (forosh.SQL_CREATE_USERS, forosh.SQL_CREATE_PRODUCTS, forosh.SQL_CREATE_PURCHASES,
+                forosh.SQL_CREATE_REGISTERED_USERS, forosh.SQL_CREATE_BANNED_USERS, forosh.SQL_CREATE_CATALOG,
+                forosh.SQL_CREATE_SERVICE_FILES, forosh.SQL_CREATE_SERVICE_CODES,
+                forosh.SQL_CREATE_SERVICE_CODES_BY_PRODUCT, forosh.SQL_CREATE_SETTINGS):
+        connection.execute(sql)
+    return connection
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else "user_data.json"
+    target = sys.argv[2] if len(sys.argv) > 2 else forosh.DB_FILE
+    import snap
+    # registered_users.log and the sales series sit next to the save, wherever this is run from.
+    data_dir = os.path.dirname(os.path.normpath(source))
+    products_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(data_dir, snap.SALES_SERIES_DIR, "products.json")
+    snap_product_names = []
+    if os.path.exists(products_path):
+        with open(products_path, "r", encoding="utf-8") as f:
+            snap_product_names = json.load(f)
+
+    connection = open_target(target)
+    if connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]:
+        sys.exit(f"{target} already has users; migrate into an empty database.")
+    migration = Migration(connection, snap_product_names)
+
+    started = time.monotonic()
+    last_report = started
+    sharded = os.path.isdir(source)
+    total_bytes = 0 if sharded else os.path.getsize(source)
+
+    def progress(done: int, total: int = total_bytes) -> None:
+        nonlocal last_report
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            print(f"{100 * done / max(total, 1):5.1f}%  users {migration.counts['users']}  "
+                  f"purchases {migration.counts['purchases']}  {now - started:.0f}s", file=sys.stderr)
+
+    if sharded:
+        reader = iter_sharded_source
+    elif source.endswith(".snap"):
+        reader = iter_snapshot_source
+    else:
+        reader = iter_json_source
+    try:
+        for item in reader(source, progress):
+            migration.add(item)
+    except (ValueError, EOFError, OSError, struct.error, zlib.error) as e:
+        # snap.py itself would fall back to the .prev copy; pick that as the source explicitly.
+        sys.exit(f"could not read {source}: {e}\nDelete {target} before migrating again.")
+    migration.flush()
+    errors = migration.verify()
+    # The legacy layout can leave a field unset for users missing from one of its dicts.
+    connection.execute("UPDATE users SET balance = COALESCE(balance, 0), charged = COALESCE(charged, 0), "
+                       "purchased = COALESCE(purchased, 0)")
+    for sql in (forosh.SQL_CREATE_PURCHASES_BY_USER, forosh.SQL_CREATE_PURCHASES_BY_TIME):
+        connection.execute(sql)
+    # The bot only seeds its catalog when upgrading an older database, so the copy fills it.
+    copied = migration.copy_bot_state(read_registered_users(os.path.join(data_dir, snap.REGISTERED_USERS_FILE)))
+    connection.execute(f"PRAGMA user_version = {forosh.DB_SCHEMA_VERSION}")
+    connection.commit()
+
+    (users,) = connection.execute("SELECT COUNT(*) FROM users").fetchone()
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.close()
+    print(f"migrated {users} users and {migration.counts['purchases']} purchases in {time.monotonic() - started:.1f}s")
+    print(f"copied {copied['products']} products, {copied['codes']} codes, {copied['banned']} banned users "
+          f"and {copied['registered']} registered users")
+    if errors:
+        sys.exit("row counts do not match:\n" + "\n".join(errors))
+    print("row counts verified")
+
+if __name__ == "__main__":
+    main()
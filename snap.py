@@ -3,9 +3,30 @@ import logging
 import asyncio
 import datetime
 import os
+import time
 import json
+import io
+import csv
+import bisect
+import gzip
+import functools
+import itertools
+import struct
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import nest_asyncio
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaPhoto,
+    InputMediaDocument,
+    InputMediaVideo,
+)
 import telegram.error
 from telegram.ext import (
     Application,
@@ -15,7 +36,15 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
 )
+from conversation_persistence import ConversationDatabase, SQLitePersistence
+
+try:
+    import numpy as np                 # optional: vectorized sales rollups
+except ImportError:
+    np = None
 
 nest_asyncio.apply()
 
@@ -38,11 +67,59 @@ MANDATORY_CHANNEL = "@bxbxbxbxjxxj"       # Replace with your actual channel use
 # Global modifiable product prices dictionary with an initial product.
 PRODUCT_PRICES = {"🍔کد 170/300 اسنپ فود🍕": 30000}
 
+# Broadcast limits (Telegram allows ~30 messages/s per bot and ~1 message/s per chat)
+BROADCAST_CONCURRENCY = 20             # parallel send workers per broadcast
+BROADCAST_GLOBAL_RATE = 25             # messages per second across all chats
+BROADCAST_PER_CHAT_INTERVAL = 1.0      # seconds between two messages to the same chat
+BROADCAST_MAX_RETRIES = 3              # retries after RetryAfter / network errors
+BROADCAST_PROGRESS_INTERVAL = 5        # seconds between progress updates to the admin
+BROADCAST_CHECKPOINT_EVERY = 100       # sends between two checkpoints of a broadcast job
+BROADCAST_JOBS_DIR = 'broadcast_jobs'  # persisted broadcast jobs (state + recipient list)
+BROADCAST_ALBUM_MAX_ITEMS = 10         # Telegram's limit for one media group
+SEGMENT_INDEX_DAYS = 30                # days of purchase history kept in the buyers-by-day index
+SALES_SERIES_DIR = 'sales'             # column files of the per-product sales series
+USER_COLUMNS_ENABLED = True            # keep balance / charged / purchased in dense columns for fleet aggregates
+BALANCE_SEGMENT_THRESHOLDS = (30000, 100000)   # "balance above X" broadcast segments offered to the admin
+
+# Purchase history retention
+PURCHASE_HOT_DAYS = 30                 # purchases younger than this stay in memory / user_data.json
+PURCHASE_HOT_MAX_ENTRIES = 200         # ring buffer size per user
+PURCHASE_ARCHIVE_DIR = 'purchase_archive'   # gzip-compressed JSON lines, one file per day
+PURCHASE_RETENTION_INTERVAL = 3600     # seconds between sweeps that move old purchases to the archive
+
+# Sharded user storage
+USER_SHARDS = 0                        # >0 splits users over this many snapshot files in USER_SHARD_DIR; 0 keeps one file
+USER_SHARD_DIR = 'user_shards'         # shard files users-NNN.snap plus state.snap
+USER_SHARD_LOAD_THREADS = 4            # shards read and decompressed in parallel at startup
+
+# Online backups
+BACKUP_DIR = 'backups'                 # compressed user snapshots, newest last by name
+BACKUP_INTERVAL = 6 * 3600             # seconds between scheduled backups
+BACKUP_KEEP = 28                       # backups kept before the oldest are deleted
+BACKUP_COMPRESS_LEVEL = 6              # gzip level for backup files
+BACKUP_CAPTURE_CHUNK = 5000            # users copied between two yields to the event loop
+
+# Admin conversations
+CONVERSATION_DB_FILE = 'conversations.db'   # conversation states and context.user_data
+CONVERSATION_PERSIST_INTERVAL = 10     # seconds between writes of conversation states and context.user_data
+CONVERSATION_TIMEOUT = 600             # seconds an admin flow may wait for its next message before it ends
+CONTEXT_CLEANUP_INTERVAL = 3600        # seconds between sweeps of context.user_data
+CONTEXT_MAX_IDLE = 86400               # context.user_data of a user idle this long is dropped
+
+# Low-stock alerts
+LOW_STOCK_VELOCITY_HOURS = 24          # sales window used to estimate each product's sales rate
+LOW_STOCK_ALERT_HOURS = (24, 6, 1)     # alert when a product is forecast to run out within these hours
+LOW_STOCK_ALERT_CODES = 5              # ...or when this few codes are left, whatever the sales rate
+LOW_STOCK_CHECK_INTERVAL = 300         # seconds between watcher runs
+LOW_STOCK_MIN_ALERT_INTERVAL = 1800    # minimum seconds between two alert messages to the admin
+
 # =====================================================================
 # Conversation States for User and Admin Tasks
 # =====================================================================
 # Admin Broadcast
 ADMIN_BROADCAST_MESSAGE = 90
+ADMIN_BROADCAST_SEGMENT = 91
+ADMIN_BROADCAST_ALBUM = 92
 
 # Admin Add/Subtract Credit
 ADMIN_ADD_AMOUNT = 10
@@ -93,16 +170,26 @@ ADMIN_DELETE_CODE_INPUT = 601
 # =====================================================================
 # Global Dictionaries and Sets for Data Storage
 # =====================================================================
-USER_BALANCES = {}                     # user_id -> current balance
-USER_CHARGED = {}                      # user_id -> total charged amount
-USER_PURCHASED = {}                    # user_id -> total purchased count
-USER_RECENT_PURCHASES = {}             # user_id -> list of tuples (timestamp, product)
+class UserRecord:
+    # One slotted object per user instead of four parallel dicts keyed by user_id.
+    __slots__ = ("balance", "charged", "purchased", "purchases")
+
+    def __init__(self, balance: int = 0, charged: int = 0, purchased: int = 0, purchases: deque = None):
+        self.balance = balance              # current balance
+        self.charged = charged              # total charged amount
+        self.purchased = purchased          # total purchased count
+        self.purchases = purchases          # deque of (epoch seconds, product id, price), None until the first purchase
+
+USERS = {}                             # user_id -> UserRecord
+EMPTY_USER = UserRecord()              # read-only stand-in for users without a record
 BANNED_USERS = {}                      # user_id -> True if banned
 
 SERVICE_CODES = {}                     # product name -> list of available codes
 SERVICE_FILE_PATH = {}                 # product name -> file path
+INVENTORY = {}                         # product name -> stock gauges kept next to SERVICE_CODES
 
 REGISTERED_USERS = set()               # Users who started the bot (for broadcast)
+DEAD_USERS = {}                        # user_id -> reason the user can no longer be reached
 
 BOT_ACTIVE = True                      # Global bot status
 
@@ -110,31 +197,1287 @@ BOT_ACTIVE = True                      # Global bot status
 # Persistent Storage Functions
 # =====================================================================
 DATA_FILE = 'user_data.json'
+SNAPSHOT_FILE = 'user_data.snap'       # binary snapshot, preferred over DATA_FILE when USER_DATA_FORMAT is "binary"
+USER_DATA_FORMAT = "binary"            # "binary" or "json"
+SNAPSHOT_COMPRESS = True               # gzip the binary snapshot (level 1)
+SAVE_GROUP_WINDOW = 0.05               # seconds of changes gathered into one save + fsync
+REGISTERED_USERS_FILE = 'registered_users.log'   # one user id per line, appended on a user's first /start
+JSON_CHECKSUM_PREFIX = b"\n#crc32 "
+
+def json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, deque):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
 def save_user_data():
+    capture_user_data()()
+
+def capture_user_data():
+    # Copies everything a save needs on the event loop; the returned function
+    # only writes that copy, so it may run on a worker thread.
+    stage_purchase_archive()
+    return functools.partial(write_user_data, capture_user_files())
+
+def write_user_data(write) -> None:
+    write()
+    # Evicted purchases are archived only once the save that no longer holds
+    # them is on disk; a failed save leaves them staged for the next one.
+    write_purchase_archive()
+
+def capture_user_files():
+    if USER_SHARDS:
+        return capture_user_shards()
+    if USER_DATA_FORMAT == "binary":
+        columns = new_snapshot_columns()
+        pack_user_records(columns, USERS.items())
+        return functools.partial(write_user_snapshot, SNAPSHOT_FILE, columns, encode_user_state(),
+                                 1 if SNAPSHOT_COMPRESS else 0)
     data = {
-        "USER_BALANCES": USER_BALANCES,
-        "USER_CHARGED": USER_CHARGED,
-        "USER_PURCHASED": USER_PURCHASED,
-        "USER_RECENT_PURCHASES": USER_RECENT_PURCHASES
+        # user_id -> [balance, charged, purchased, purchases]
+        "USERS": {user_id: [record.balance, record.charged, record.purchased, record.purchases or []]
+                  for user_id, record in USERS.items()},
+        **get_user_state(),
+    }
+    body = json.dumps(data, ensure_ascii=False, indent=4, default=json_default).encode("utf-8")
+    return functools.partial(write_file_atomically, DATA_FILE, functools.partial(write_checksummed_json, body))
+
+def write_checksummed_json(body: bytes, f) -> None:
+    # The checksum goes on its own line after the closing brace, where JSON readers stop.
+    f.write(body)
+    f.write(JSON_CHECKSUM_PREFIX + b"%08x\n" % zlib.crc32(body))
+
+def read_checksummed_json(path: str) -> dict:
+    with open(path, "rb") as f:
+        data = f.read()
+    body, prefix, checksum = data.rpartition(JSON_CHECKSUM_PREFIX)
+    if not prefix:
+        # Saved before checksums were added.
+        body = data
+    elif int(checksum, 16) != zlib.crc32(body):
+        raise ValueError(f"{path} failed its checksum")
+    return json.loads(body)
+
+def write_file_atomically(path: str, write) -> None:
+    # write(f) fills a temporary file that replaces path only once it is on
+    # disk, so a crash leaves either the old file or the new one. The file
+    # being replaced stays around as path + ".prev".
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(path):
+        previous_path = path + ".prev"
+        if os.path.exists(previous_path):
+            os.remove(previous_path)
+        os.link(path, previous_path)
+    os.replace(temp_path, path)
+    if hasattr(os, "O_DIRECTORY"):
+        # The rename itself is only durable once the directory is flushed.
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+# Handlers call schedule_user_data_save() after changing users and carry on:
+# updates are handled one at a time, so a handler waiting for the disk would
+# hold up every update behind it. All changes made within SAVE_GROUP_WINDOW
+# share one save and one fsync. Background tasks that must know their changes
+# are on disk await commit_user_data() instead.
+SAVE_PENDING = None                    # future of the next group save, while it is still gathering
+SAVE_TASK = None
+SAVE_LOCK = asyncio.Lock()
+
+def schedule_user_data_save() -> asyncio.Future:
+    global SAVE_PENDING, SAVE_TASK
+    if SAVE_PENDING is None:
+        SAVE_PENDING = asyncio.get_running_loop().create_future()
+        SAVE_TASK = asyncio.create_task(group_save(SAVE_PENDING))
+    return SAVE_PENDING
+
+async def commit_user_data() -> None:
+    # A cancelled caller must not cancel the save the others are waiting on.
+    await asyncio.shield(schedule_user_data_save())
+
+async def group_save(done: asyncio.Future) -> None:
+    global SAVE_PENDING
+    await asyncio.sleep(SAVE_GROUP_WINDOW)
+    async with SAVE_LOCK:
+        # Changes made from here on belong to the next group.
+        SAVE_PENDING = None
+        try:
+            write = capture_user_data()
+            await asyncio.to_thread(write)
+        except Exception as e:
+            logger.exception("Saving user data failed")
+            done.set_exception(e)
+            # Already logged; nobody may be waiting on a scheduled save.
+            done.exception()
+        else:
+            done.set_result(None)
+
+def get_user_state() -> dict:
+    # Everything saved next to the user table; small enough to stay JSON in both formats.
+    return {
+        "DEAD_USERS": DEAD_USERS,
+        "PRODUCT_BUYERS": {product: sorted(users) for product, users in PRODUCT_BUYERS.items()},
+        "SALES_COUNTERS": {"sales": SALES_COUNTER.to_dict(), "charges": CHARGE_COUNTER.to_dict()},
+        "TOP_K": {
+            "buyers": {window: TOP_BUYERS[window].to_dict() for window in ("today", "week")},
+            "chargers": {window: TOP_CHARGERS[window].to_dict() for window in ("today", "week")},
+        },
+        "INVENTORY": INVENTORY,
+        # Saved with the balances, so a sold code and the payment for it reach disk together.
+        "BOT_STATE": {
+            "PRODUCT_PRICES": PRODUCT_PRICES,
+            "SERVICE_CODES": SERVICE_CODES,
+            "SERVICE_FILE_PATH": SERVICE_FILE_PATH,
+            "BANNED_USERS": [user_id for user_id, banned in BANNED_USERS.items() if banned],
+            "BOT_ACTIVE": BOT_ACTIVE,
+        },
     }
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
 
 def load_user_data():
-    global USER_BALANCES, USER_CHARGED, USER_PURCHASED, USER_RECENT_PURCHASES
+    global USERS, DEAD_USERS
+    DIRTY_SHARDS.clear()
+    if user_shards_are_newest():
+        load_user_shards()
+        return
+    # Everything is written to the shards the first time they are saved.
+    mark_all_shards_dirty()
+    # A damaged file falls back to the copy it replaced.
+    if USER_DATA_FORMAT == "binary":
+        for path in (SNAPSHOT_FILE, SNAPSHOT_FILE + ".prev"):
+            if not os.path.exists(path):
+                continue
+            try:
+                load_user_snapshot(path)
+                return
+            except (ValueError, EOFError, OSError, struct.error, zlib.error) as e:
+                logger.error(f"Could not load {path}: {e}")
+    for path in (DATA_FILE, DATA_FILE + ".prev"):
+        try:
+            load_json_user_data(path)
+            return
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            logger.error(f"Could not load {path}: {e}")
+    USERS = {}
+    DEAD_USERS = {}
+
+def load_json_user_data(path: str) -> None:
+    global USERS
+    data = read_checksummed_json(path)
+    # JSON object keys are strings; handlers look users up by int id.
+    USERS = {}
+    if "USERS" in data:
+        for user_id, (balance, charged, purchased, purchases) in data["USERS"].items():
+            USERS[int(user_id)] = UserRecord(balance, charged, purchased,
+                                             parse_purchase_history(int(user_id), purchases))
+    else:
+        load_legacy_user_dicts(data)
+    restore_user_state(data)
+
+def restore_user_state(data: dict) -> None:
+    global DEAD_USERS, INVENTORY
+    restore_bot_state(data.get("BOT_STATE"))
+    DEAD_USERS = {int(user_id): reason for user_id, reason in data.get("DEAD_USERS", {}).items()}
+    for product, users in data.get("PRODUCT_BUYERS", {}).items():
+        PRODUCT_BUYERS[product] = set(users)
+    counters = data.get("SALES_COUNTERS")
+    if counters:
+        SALES_COUNTER.restore(counters["sales"])
+        CHARGE_COUNTER.restore(counters["charges"])
+    else:
+        rebuild_sales_counter()
+    top_k = data.get("TOP_K", {})
+    for window in ("today", "week"):
+        TOP_BUYERS[window].restore(top_k.get("buyers", {}).get(window))
+        TOP_CHARGERS[window].restore(top_k.get("chargers", {}).get(window))
+    INVENTORY = data.get("INVENTORY", {})
+    for product, gauges in INVENTORY.items():
+        # Stock gauges follow whatever codes are actually loaded right now.
+        gauges["remaining"] = len(SERVICE_CODES.get(product, []))
+        gauges.pop("reserved", None)
+
+def restore_bot_state(state: dict) -> None:
+    global BOT_ACTIVE
+    # Files saved before bot state was added keep the built-in defaults.
+    if not state:
+        return
+    PRODUCT_PRICES.clear()
+    PRODUCT_PRICES.update(state["PRODUCT_PRICES"])
+    SERVICE_CODES.clear()
+    SERVICE_CODES.update(state["SERVICE_CODES"])
+    SERVICE_FILE_PATH.clear()
+    SERVICE_FILE_PATH.update(state["SERVICE_FILE_PATH"])
+    BANNED_USERS.clear()
+    BANNED_USERS.update((user_id, True) for user_id in state["BANNED_USERS"])
+    BOT_ACTIVE = state["BOT_ACTIVE"]
+
+def register_user(user_id: int) -> None:
+    # Registrations only ever grow, so each new user is one appended line
+    # instead of a rewrite of the whole set.
+    if user_id in REGISTERED_USERS:
+        return
+    REGISTERED_USERS.add(user_id)
+    with open(REGISTERED_USERS_FILE, "a", encoding="utf-8") as f:
+        f.write(f"{user_id}\n")
+
+def load_registered_users() -> None:
+    try:
+        with open(REGISTERED_USERS_FILE, "r", encoding="utf-8") as f:
+            # A line cut short by a crash has no newline and is skipped.
+            REGISTERED_USERS.update(int(line) for line in f if line.endswith("\n"))
+    except FileNotFoundError:
+        pass
+
+def load_legacy_user_dicts(data: dict) -> None:
+    # Data files written before UserRecord kept four dicts keyed by user_id.
+    for field, key in (("balance", "USER_BALANCES"), ("charged", "USER_CHARGED"), ("purchased", "USER_PURCHASED")):
+        for user_id, value in data.get(key, {}).items():
+            setattr(get_or_create_user(int(user_id)), field, value)
+    for user_id, purchases in data.get("USER_RECENT_PURCHASES", {}).items():
+        get_or_create_user(int(user_id)).purchases = parse_purchase_history(int(user_id), purchases)
+
+def get_user(user_id: int) -> UserRecord:
+    # For reads only; the shared EMPTY_USER must never be modified.
+    return USERS.get(user_id, EMPTY_USER)
+
+def get_or_create_user(user_id: int) -> UserRecord:
+    record = USERS.get(user_id)
+    if record is None:
+        record = USERS[user_id] = UserRecord()
+    # Callers change the record they get back.
+    mark_user_dirty(user_id)
+    return record
+
+# =====================================================================
+# Binary User Snapshot
+# =====================================================================
+# Layout: a fixed header, then one packed column per field (user ids,
+# balances, charged, purchased, purchases per user, and the flattened
+# purchase timestamps / product ids / prices), then the JSON-encoded
+# get_user_state(). Columns are read straight into arrays, so loading is a
+# few large reads instead of parsing one token at a time. Purchases saved
+# without a price store -1. A CRC-32 of the uncompressed contents ends the file.
+SNAPSHOT_MAGIC = b"SNAPUSR1"
+SNAPSHOT_HEADER = struct.Struct("<8sQQQ")   # magic, users, purchases, state length
+SNAPSHOT_TRAILER = struct.Struct("<I")      # CRC-32 of everything before it
+
+def new_snapshot_columns() -> tuple:
+    # user ids, balances, charged, purchased, purchase counts, timestamps, product ids, prices
+    return array('q'), array('q'), array('q'), array('q'), array('I'), array('q'), array('I'), array('q')
+
+def pack_user_records(columns: tuple, items) -> None:
+    user_ids, balances, charged, purchased, counts, timestamps, products, prices = columns
+    for user_id, record in items:
+        user_ids.append(user_id)
+        balances.append(record.balance)
+        charged.append(record.charged)
+        purchased.append(record.purchased)
+        history = record.purchases or ()
+        counts.append(len(history))
+        for entry in history:
+            timestamps.append(entry[0])
+            products.append(entry[1])
+            prices.append(entry[2] if len(entry) > 2 else -1)
+
+def encode_user_state() -> bytes:
+    return json.dumps(get_user_state(), ensure_ascii=False, default=json_default).encode("utf-8")
+
+def write_user_snapshot(path: str, columns: tuple, state: bytes, compresslevel: int) -> None:
+    # Touches no shared state, so saves and backups run it on a worker thread.
+    def write(f):
+        out = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=compresslevel) if compresslevel else f
+        checksum = 0
+        for part in (SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(columns[0]), len(columns[5]), len(state)),
+                     *columns, state):
+            out.write(part)
+            checksum = zlib.crc32(part, checksum)
+        out.write(SNAPSHOT_TRAILER.pack(checksum))
+        if out is not f:
+            out.close()
+    write_file_atomically(path, write)
+
+def read_snapshot_column(f, typecode: str, length: int) -> array:
+    column = array(typecode)
+    data = f.read(length * column.itemsize)
+    if len(data) != length * column.itemsize:
+        raise ValueError("user snapshot is truncated")
+    column.frombytes(data)
+    return column
+
+def read_user_snapshot(path: str) -> tuple:
+    # Returns the snapshot's eight columns and its decoded state without
+    # touching USERS, so shards can be read on worker threads.
+    with open(path, "rb") as raw:
+        compressed = raw.read(2) == b"\x1f\x8b"
+    with (gzip.open(path, "rb") if compressed else open(path, "rb")) as f:
+        header = f.read(SNAPSHOT_HEADER.size)
+        if len(header) != SNAPSHOT_HEADER.size:
+            raise ValueError(f"{path} is truncated")
+        magic, user_count, purchase_count, state_length = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a user snapshot")
+        columns = [read_snapshot_column(f, typecode, user_count) for typecode in "qqqqI"]
+        columns += [read_snapshot_column(f, typecode, purchase_count) for typecode in "qIq"]
+        state = f.read(state_length)
+        trailer = f.read(SNAPSHOT_TRAILER.size)
+    if len(state) != state_length:
+        raise ValueError(f"{path} is truncated")
+    # Snapshots written before checksums were added end right after the state.
+    if trailer:
+        checksum = zlib.crc32(header)
+        for part in (*columns, state):
+            checksum = zlib.crc32(part, checksum)
+        if len(trailer) != SNAPSHOT_TRAILER.size or SNAPSHOT_TRAILER.unpack(trailer)[0] != checksum:
+            raise ValueError(f"{path} failed its checksum")
+    return columns, json.loads(state.decode("utf-8"))
+
+def unpack_user_records(columns: list, users: dict) -> None:
+    user_ids, balances, charged, purchased, counts, timestamps, products, prices = columns
+    start = 0
+    for user_id, balance, charged_total, purchased_total, count in zip(user_ids, balances, charged, purchased, counts):
+        history = None
+        if count:
+            end = start + count
+            history = deque(((timestamp, product, price) if price >= 0 else (timestamp, product)
+                             for timestamp, product, price in zip(timestamps[start:end], products[start:end], prices[start:end])),
+                            maxlen=PURCHASE_HOT_MAX_ENTRIES)
+            start = end
+            trim_purchase_history(user_id, history)
+        users[user_id] = UserRecord(balance, charged_total, purchased_total, history or None)
+
+def load_user_snapshot(path: str = SNAPSHOT_FILE) -> None:
+    global USERS
+    columns, state = read_user_snapshot(path)
+    USERS = {}
+    unpack_user_records(columns, USERS)
+    restore_user_state(state)
+
+# =====================================================================
+# Sharded User Storage
+# =====================================================================
+# With USER_SHARDS set, users are split by user_id % USER_SHARDS over that
+# many binary snapshots, and everything get_user_state() returns goes to
+# its own state.snap. Changing a user marks its shard dirty; a save
+# rewrites only the dirty shards plus the state file, so one purchase
+# costs about 1/USER_SHARDS of a full save. Each shard file is replaced
+# atomically on its own, which keeps every user's record consistent; a
+# crash between two shard writes can leave the state file one save behind
+# some users. Startup reads all shards in parallel.
+#
+# Shard files are named after the shard count, and state.snap records the
+# count it was saved with. Changing USER_SHARDS between runs writes a full
+# set of files under the new names; the old set is read until state.snap
+# points at the new one, and deleted after.
+DIRTY_SHARDS = set()                   # shards changed since the last save
+
+def mark_user_dirty(user_id: int) -> None:
+    if USER_SHARDS:
+        DIRTY_SHARDS.add(user_id % USER_SHARDS)
+
+def mark_all_shards_dirty() -> None:
+    DIRTY_SHARDS.update(range(USER_SHARDS))
+
+def user_shard_path(shard: int, shard_count: int) -> str:
+    return os.path.join(USER_SHARD_DIR, f"users-{shard_count:03d}-{shard:03d}.snap")
+
+def user_shard_state_path() -> str:
+    return os.path.join(USER_SHARD_DIR, "state.snap")
+
+def capture_user_shards():
+    shards = {shard: [] for shard in DIRTY_SHARDS}
+    DIRTY_SHARDS.clear()
+    if shards:
+        for user_id, record in USERS.items():
+            items = shards.get(user_id % USER_SHARDS)
+            if items is not None:
+                items.append((user_id, record))
+    for shard, items in shards.items():
+        shards[shard] = columns = new_snapshot_columns()
+        pack_user_records(columns, items)
+    state = json.dumps({**get_user_state(), "USER_SHARDS": USER_SHARDS},
+                       ensure_ascii=False, default=json_default).encode("utf-8")
+    return functools.partial(write_user_shards, shards, state, USER_SHARDS, 1 if SNAPSHOT_COMPRESS else 0)
+
+def write_user_shards(shards: dict, state: bytes, shard_count: int, compresslevel: int) -> None:
+    os.makedirs(USER_SHARD_DIR, exist_ok=True)
+    try:
+        for shard, columns in shards.items():
+            write_user_snapshot(user_shard_path(shard, shard_count), columns, b"{}", compresslevel)
+    except BaseException:
+        # Shards that may not have reached disk are written again by the next save.
+        DIRTY_SHARDS.update(shards)
+        raise
+    write_user_snapshot(user_shard_state_path(), new_snapshot_columns(), state, compresslevel)
+    if len(shards) == shard_count:
+        current = f"users-{shard_count:03d}-"
+        for name in os.listdir(USER_SHARD_DIR):
+            if name.startswith("users-") and not name.startswith(current):
+                os.remove(os.path.join(USER_SHARD_DIR, name))
+
+def read_user_shard(path: str) -> tuple:
+    try:
+        return read_user_snapshot(path)
+    except (ValueError, EOFError, OSError, struct.error, zlib.error) as e:
+        logger.error(f"Could not load {path}: {e}")
+    # Unlike the single file there is nothing older to fall back to, so a
+    # shard with no readable copy stops the bot instead of losing its users.
+    return read_user_snapshot(path + ".prev")
+
+def load_user_shards() -> None:
+    global USERS
+    _, state = read_user_shard(user_shard_state_path())
+    shard_count = state["USER_SHARDS"]
+    USERS = {}
+    with ThreadPoolExecutor(max_workers=USER_SHARD_LOAD_THREADS) as pool:
+        paths = [user_shard_path(shard, shard_count) for shard in range(shard_count)]
+        for columns, _ in pool.map(read_user_shard, paths):
+            unpack_user_records(columns, USERS)
+    restore_user_state(state)
+    if shard_count != USER_SHARDS:
+        mark_all_shards_dirty()
+
+def user_shards_are_newest() -> bool:
+    # The sharded files win when sharding is on, or when they were saved
+    # after the single file (sharding was switched off since).
+    if not os.path.exists(user_shard_state_path()):
+        return False
+    if USER_SHARDS:
+        return True
+    single_files = [path for path in (SNAPSHOT_FILE, DATA_FILE) if os.path.exists(path)]
+    return all(os.path.getmtime(user_shard_state_path()) > os.path.getmtime(path) for path in single_files)
+
+# =====================================================================
+# Conversation Persistence
+# =====================================================================
+# Admin conversation states and context.user_data are kept in
+# CONVERSATION_DB_FILE by conversation_persistence.SQLitePersistence.
+
+# Handlers never remove their context.user_data keys, and PTB keeps a dict
+# for every user it has seen. Flows that time out clear theirs right away;
+# the worker below drops empty dicts and those of users idle for
+# CONTEXT_MAX_IDLE, which covers flows whose timeout never ran (e.g. ones
+# restored after a restart).
+CONTEXT_LAST_SEEN = {}                 # user_id -> monotonic time of the last update, for users holding context.user_data
+
+async def note_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user and context.user_data:
+        CONTEXT_LAST_SEEN[update.effective_user.id] = time.monotonic()
+
+def conversation_timed_out(*keys: str) -> TypeHandler:
+    # A flow's TIMEOUT state pops only that flow's keys, so the admin's other
+    # flows still in progress keep theirs.
+    async def timed_out(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        for key in keys:
+            context.user_data.pop(key, None)
+    return TypeHandler(Update, timed_out)
+
+async def user_context_cleanup_worker(application: Application) -> None:
+    while True:
+        await asyncio.sleep(CONTEXT_CLEANUP_INTERVAL)
+        now = time.monotonic()
+        dropped = 0
+        for user_id, data in list(application.user_data.items()):
+            if data:
+                # Users with data from before the first sweep count as seen now.
+                last_seen = CONTEXT_LAST_SEEN.setdefault(user_id, now)
+                if now - last_seen < CONTEXT_MAX_IDLE:
+                    continue
+                dropped += 1
+            CONTEXT_LAST_SEEN.pop(user_id, None)
+            application.drop_user_data(user_id)
+        if dropped:
+            logger.info(f"Dropped idle context.user_data of {dropped} users")
+
+# =====================================================================
+# Online Backups
+# =====================================================================
+# A backup is a user snapshot written to BACKUP_DIR while the bot keeps
+# serving. Users are copied into fresh columns a chunk at a time, yielding
+# to the event loop in between, so each record is copied whole and no
+# handler waits for more than one chunk; compression and the file write
+# then run on a worker thread. To restore, copy a backup to SNAPSHOT_FILE
+# (and move USER_SHARD_DIR away if sharding is on).
+BACKUP_LOCK = asyncio.Lock()
+
+async def backup_user_data() -> dict:
+    async with BACKUP_LOCK:
+        started = time.perf_counter()
+        columns = new_snapshot_columns()
+        # Only the ids are copied up front: a list of (id, record) pairs for
+        # every user allocates enough tuples to set off a full GC pass.
+        user_ids = list(USERS)
+        longest_pause = time.perf_counter() - started
+        for start in range(0, len(user_ids), BACKUP_CAPTURE_CHUNK):
+            await asyncio.sleep(0)
+            chunk_started = time.perf_counter()
+            pack_user_records(columns, ((user_id, USERS[user_id]) for user_id in user_ids[start:start + BACKUP_CAPTURE_CHUNK]))
+            longest_pause = max(longest_pause, time.perf_counter() - chunk_started)
+        state = encode_user_state()
+        captured = time.perf_counter()
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        path = os.path.join(BACKUP_DIR, f"user_data-{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.snap.gz")
+        await asyncio.to_thread(write_user_snapshot, path, columns, state, BACKUP_COMPRESS_LEVEL)
+        finished = time.perf_counter()
+        for old_backup in sorted(name for name in os.listdir(BACKUP_DIR) if name.startswith("user_data-"))[:-BACKUP_KEEP]:
+            os.remove(os.path.join(BACKUP_DIR, old_backup))
+        return {"path": path, "users": len(user_ids), "bytes": os.path.getsize(path),
+                "capture": captured - started, "write": finished - captured, "pause": longest_pause}
+
+def format_backup_result(result: dict) -> str:
+    return (f"✅پشتیبان ذخیره شد: {result['path']}\n"
+            f"👥کاربران: {result['users']} | 📦حجم: {result['bytes'] / 2**20:.1f} MB\n"
+            f"⏱کپی: {result['capture']:.2f}s | نوشتن و فشرده‌سازی: {result['write']:.2f}s\n"
+            f"⏸بیشترین توقف ربات: {result['pause'] * 1000:.0f}ms")
+
+async def run_backup(bot, chat_id: int = None) -> None:
+    try:
+        result = await backup_user_data()
+    except Exception as e:
+        logger.exception("Backup failed")
+        if chat_id is not None:
+            await bot.send_message(chat_id=chat_id, text=f"❌پشتیبان‌گیری ناموفق بود: {e}")
+        return
+    logger.info(f"Backup written to {result['path']} ({result['users']} users, "
+                f"capture {result['capture']:.2f}s, write {result['write']:.2f}s, pause {result['pause'] * 1000:.0f}ms)")
+    if chat_id is not None:
+        await bot.send_message(chat_id=chat_id, text=format_backup_result(result))
+
+BACKUP_RUNS = set()                    # scheduled backups in progress; on_stop() lets them finish
+
+async def backup_worker(application: Application) -> None:
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        # Cancelling the worker must not abandon a backup whose write is
+        # already running on a worker thread; on_stop() waits for it instead.
+        run = asyncio.create_task(run_backup(application.bot))
+        BACKUP_RUNS.add(run)
+        run.add_done_callback(BACKUP_RUNS.discard)
+        await asyncio.shield(run)
+
+# =====================================================================
+# Per-User Purchase History
+# =====================================================================
+# Each user's purchases are (epoch seconds, product id, price) tuples kept in
+# time order, so window queries are a binary search plus a slice. Product ids
+# are shared with the sales series (SALES_PRODUCT_NAMES).
+PURCHASES_PAGE_SIZE = 20               # purchases per page in the admin history view
+
+def parse_purchase_entry(entry) -> tuple:
+    # Older data files hold ISO timestamps and product names.
+    timestamp, product = entry[0], entry[1]
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    if isinstance(timestamp, datetime.datetime):
+        timestamp = epoch_seconds(timestamp)
+    if isinstance(product, str):
+        product = sales_product_id(product)
+    return (timestamp, product, *entry[2:])
+
+def format_purchase_entry(entry: tuple) -> str:
+    return (f"{from_epoch_seconds(entry[0]):%Y-%m-%d %H:%M} | {SALES_PRODUCT_NAMES[entry[1]]}" +
+            (f" | {entry[2]}" if len(entry) > 2 else ""))
+
+def parse_purchase_history(user_id: int, purchases: list):
+    history = [parse_purchase_entry(entry) for entry in purchases]
+    history.sort(key=lambda entry: entry[0])
+    # Purchases beyond the hot window go straight to the archive.
+    hot = deque(maxlen=PURCHASE_HOT_MAX_ENTRIES)
+    for entry in history:
+        append_hot_purchase(user_id, hot, entry)
+    trim_purchase_history(user_id, hot)
+    return hot or None
+
+def purchases_since(user_id: int, cutoff: datetime.datetime) -> list:
+    purchases = get_user(user_id).purchases or ()
+    start = bisect.bisect_left(purchases, epoch_seconds(cutoff), key=lambda entry: entry[0])
+    return list(itertools.islice(purchases, start, None))
+
+# =====================================================================
+# Purchase Retention and Cold Archive
+# =====================================================================
+PURCHASE_ARCHIVE_PENDING = []          # (user_id, purchase) evicted since the last save
+PURCHASE_ARCHIVE_STAGED = {}           # day -> archive lines waiting for their save to reach disk
+
+def append_hot_purchase(user_id: int, history: deque, entry: tuple) -> None:
+    if len(history) == history.maxlen:
+        PURCHASE_ARCHIVE_PENDING.append((user_id, history[0]))
+    history.append(entry)
+
+def trim_purchase_history(user_id: int, history: deque) -> None:
+    cutoff = int(time.time()) - PURCHASE_HOT_DAYS * 86400
+    if history and history[0][0] < cutoff:
+        mark_user_dirty(user_id)
+    while history and history[0][0] < cutoff:
+        PURCHASE_ARCHIVE_PENDING.append((user_id, history.popleft()))
+
+def record_purchase(user_id: int, entry: tuple) -> None:
+    record = get_or_create_user(user_id)
+    history = record.purchases
+    if history is None:
+        history = record.purchases = deque(maxlen=PURCHASE_HOT_MAX_ENTRIES)
+    append_hot_purchase(user_id, history, entry)
+    trim_purchase_history(user_id, history)
+
+def purchase_archive_path(day: datetime.date) -> str:
+    return os.path.join(PURCHASE_ARCHIVE_DIR, f"{day:%Y-%m-%d}.jsonl.gz")
+
+def stage_purchase_archive() -> None:
+    # Runs while a save is captured; only saves touch PURCHASE_ARCHIVE_STAGED,
+    # and they run one at a time under SAVE_LOCK.
+    for user_id, entry in PURCHASE_ARCHIVE_PENDING:
+        # Archive rows carry the product name so each file reads on its own.
+        line = json.dumps([user_id, entry[0], SALES_PRODUCT_NAMES[entry[1]], *entry[2:]], ensure_ascii=False)
+        PURCHASE_ARCHIVE_STAGED.setdefault(from_epoch_seconds(entry[0]).date(), []).append(line)
+    PURCHASE_ARCHIVE_PENDING.clear()
+
+def write_purchase_archive() -> None:
+    if not PURCHASE_ARCHIVE_STAGED:
+        return
+    os.makedirs(PURCHASE_ARCHIVE_DIR, exist_ok=True)
+    for day in sorted(PURCHASE_ARCHIVE_STAGED):
+        # Each write appends one gzip member; readers see the members as one stream.
+        with gzip.open(purchase_archive_path(day), "at", encoding="utf-8") as f:
+            f.write("\n".join(PURCHASE_ARCHIVE_STAGED[day]) + "\n")
+        # Dropped day by day, so a failure on a later day never appends this one twice.
+        del PURCHASE_ARCHIVE_STAGED[day]
+
+def query_purchase_archive(user_id: int, since: datetime.datetime, until: datetime.datetime) -> list:
+    # Decompresses up to one file per day, so callers run it on a worker
+    # thread. Rows keep the product name; mapping it to a sales-series id
+    # may register a new product, which only the event loop does.
+    results = []
+    day = since.date()
+    while day <= until.date():
+        path = purchase_archive_path(day)
+        if os.path.exists(path):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                try:
+                    for line in f:
+                        row = json.loads(line)
+                        if row[0] != user_id:
+                            continue
+                        timestamp = row[1]
+                        if isinstance(timestamp, str):
+                            timestamp = epoch_seconds(datetime.datetime.fromisoformat(timestamp))
+                        if epoch_seconds(since) <= timestamp <= epoch_seconds(until):
+                            results.append((timestamp, *row[2:]))
+                except EOFError:
+                    # A flush was appending this file's last member while it was read.
+                    pass
+        day += datetime.timedelta(days=1)
+    results.sort(key=lambda entry: entry[0])
+    return results
+
+async def purchase_retention_worker() -> None:
+    while True:
+        await asyncio.sleep(PURCHASE_RETENTION_INTERVAL)
+        for user_id, record in USERS.items():
+            if record.purchases:
+                trim_purchase_history(user_id, record.purchases)
+        if PURCHASE_ARCHIVE_PENDING:
+            await commit_user_data()
+
+def format_purchase_page(user_id: int, purchases: list, page: int):
+    # Newest purchases come first; returns the message text and its keyboard.
+    pages = max(1, (len(purchases) + PURCHASES_PAGE_SIZE - 1) // PURCHASES_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    end = len(purchases) - page * PURCHASES_PAGE_SIZE
+    chunk = purchases[max(0, end - PURCHASES_PAGE_SIZE):end]
+    lines = [format_purchase_entry(entry) for entry in reversed(chunk)]
+    msg = (f"خریدهای اخیر (۷ روز) - {len(purchases)} خرید - صفحه {page + 1}/{pages}:\n" +
+           ("\n".join(lines) if lines else "هیچ خریدی ثبت نشده است."))
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ جدیدتر", callback_data=f"purchasespage_{user_id}_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("قدیمی‌تر ➡️", callback_data=f"purchasespage_{user_id}_{page + 1}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
+    return msg, InlineKeyboardMarkup(keyboard)
+
+# =====================================================================
+# Hourly Sales Counters
+# =====================================================================
+STATS_WINDOW_HOURS = 168               # the stats screen reports the last 7 days
+
+def day_number(timestamp: datetime.datetime) -> int:
+    return (timestamp - datetime.datetime(1970, 1, 1)).days
+
+def hour_number(timestamp: datetime.datetime = None) -> int:
+    if timestamp is None:
+        return int(time.time() // 3600)
+    return int((timestamp - datetime.datetime(1970, 1, 1)).total_seconds() // 3600)
+
+class HourlyCounter:
+    # Fixed ring of hourly buckets; each slot remembers which hour it holds so
+    # stale slots are reset lazily when the ring wraps around.
+    def __init__(self, hours: int):
+        self.hours = hours
+        self.counts = [0] * hours
+        self.peaks = [0] * hours
+        self.stamps = [-1] * hours
+
+    def add(self, amount: int, hour: int = None) -> None:
+        hour = hour_number() if hour is None else hour
+        slot = hour % self.hours
+        if self.stamps[slot] != hour:
+            if self.stamps[slot] > hour:
+                return
+            self.stamps[slot] = hour
+            self.counts[slot] = 0
+            self.peaks[slot] = 0
+        self.counts[slot] += amount
+        self.peaks[slot] = max(self.peaks[slot], amount)
+
+    def _live_slots(self, last_hours: int):
+        now = hour_number()
+        span = min(last_hours, self.hours)
+        return [slot for slot, hour in enumerate(self.stamps) if now - span < hour <= now]
+
+    def total(self, last_hours: int) -> int:
+        return sum(self.counts[slot] for slot in self._live_slots(last_hours))
+
+    def peak(self, last_hours: int) -> int:
+        return max((self.peaks[slot] for slot in self._live_slots(last_hours)), default=0)
+
+    def to_dict(self) -> dict:
+        return {"counts": self.counts, "peaks": self.peaks, "stamps": self.stamps}
+
+    def restore(self, data: dict) -> None:
+        if len(data.get("stamps", [])) == self.hours:
+            self.counts = list(data["counts"])
+            self.peaks = list(data["peaks"])
+            self.stamps = list(data["stamps"])
+
+SALES_COUNTER = HourlyCounter(STATS_WINDOW_HOURS)     # codes sold per hour
+CHARGE_COUNTER = HourlyCounter(STATS_WINDOW_HOURS)    # amount charged per hour
+
+def rebuild_sales_counter() -> None:
+    # Only used for data files written before the counters were persisted.
+    oldest_hour = hour_number() - STATS_WINDOW_HOURS
+    for record in USERS.values():
+        for entry in record.purchases or ():
+            hour = entry[0] // 3600
+            if hour > oldest_hour:
+                SALES_COUNTER.add(1, hour)
+
+# =====================================================================
+# Inventory Gauges
+# =====================================================================
+def get_inventory(product: str) -> dict:
+    gauges = INVENTORY.setdefault(product, {
+        "remaining": 0,
+        "sold_today": 0,
+        "day": current_day(),
+        "stocked": 0,
+        "sold_since_restock": 0,
+    })
+    if gauges["day"] != current_day():
+        gauges["day"] = current_day()
+        gauges["sold_today"] = 0
+    return gauges
+
+def restock_inventory(product: str, count: int) -> None:
+    gauges = get_inventory(product)
+    gauges["remaining"] = count
+    gauges["stocked"] = count
+    gauges["sold_since_restock"] = 0
+    LOW_STOCK_ALERTED.pop(product, None)
+
+def record_inventory_sale(product: str) -> None:
+    gauges = get_inventory(product)
+    gauges["remaining"] -= 1
+    gauges["sold_today"] += 1
+    gauges["sold_since_restock"] += 1
+    get_sales_velocity_counter(product).add(1)
+    LOW_STOCK_DIRTY.add(product)
+
+def sell_through_rate(gauges: dict) -> float:
+    if not gauges["stocked"]:
+        return 0.0
+    return 100.0 * gauges["sold_since_restock"] / gauges["stocked"]
+
+def total_codes_available() -> int:
+    # One entry per product, so this stays cheap however many codes are loaded.
+    return sum(gauges["remaining"] for gauges in INVENTORY.values())
+
+# =====================================================================
+# Depletion Forecasting and Low-Stock Alerts
+# =====================================================================
+SALES_VELOCITY = {}                    # product name -> HourlyCounter of recent sales
+LOW_STOCK_ALERTED = {}                 # product name -> most urgent alert level already sent
+LOW_STOCK_DIRTY = set()                # products sold since the watcher last looked
+LOW_STOCK_PENDING = {}                 # product name -> alert line waiting to be sent
+LOW_STOCK_LAST_ALERT = 0.0             # monotonic time of the last alert message
+
+def get_sales_velocity_counter(product: str) -> "HourlyCounter":
+    if product not in SALES_VELOCITY:
+        SALES_VELOCITY[product] = HourlyCounter(LOW_STOCK_VELOCITY_HOURS)
+    return SALES_VELOCITY[product]
+
+def rebuild_sales_velocity() -> None:
+    # Walk the sales series backwards until it leaves the velocity window.
+    oldest = (hour_number() - LOW_STOCK_VELOCITY_HOURS + 1) * 3600
+    for row in range(len(SALES_TIMESTAMPS) - 1, -1, -1):
+        timestamp = SALES_TIMESTAMPS[row]
+        if timestamp < oldest:
+            break
+        product = SALES_PRODUCT_NAMES[SALES_PRODUCTS[row]]
+        get_sales_velocity_counter(product).add(1, timestamp // 3600)
+
+def hours_until_empty(product: str):
+    remaining = get_inventory(product)["remaining"]
+    per_hour = get_sales_velocity_counter(product).total(LOW_STOCK_VELOCITY_HOURS) / LOW_STOCK_VELOCITY_HOURS
+    if per_hour == 0:
+        return None
+    return remaining / per_hour
+
+def low_stock_level(product: str) -> int:
+    # 0 means no alert; higher numbers are more urgent thresholds.
+    remaining = get_inventory(product)["remaining"]
+    if remaining == 0:
+        return 0
+    level = 0
+    forecast = hours_until_empty(product)
+    if forecast is not None:
+        for index, hours in enumerate(LOW_STOCK_ALERT_HOURS, start=1):
+            if forecast <= hours:
+                level = index
+    if remaining <= LOW_STOCK_ALERT_CODES:
+        level = max(level, 1)
+    return level
+
+def collect_low_stock_alerts() -> None:
+    for product in list(LOW_STOCK_DIRTY):
+        LOW_STOCK_DIRTY.discard(product)
+        level = low_stock_level(product)
+        if level <= LOW_STOCK_ALERTED.get(product, 0):
+            continue
+        LOW_STOCK_ALERTED[product] = level
+        gauges = get_inventory(product)
+        forecast = hours_until_empty(product)
+        eta = f"حدود {forecast:.1f} ساعت" if forecast is not None else "نامشخص"
+        LOW_STOCK_PENDING[product] = f"⚠️{product}: {gauges['remaining']} کد باقی‌مانده | زمان تا اتمام: {eta}"
+
+async def low_stock_watcher(application: Application) -> None:
+    global LOW_STOCK_LAST_ALERT
+    while True:
+        await asyncio.sleep(LOW_STOCK_CHECK_INTERVAL)
+        collect_low_stock_alerts()
+        if not LOW_STOCK_PENDING or time.monotonic() - LOW_STOCK_LAST_ALERT < LOW_STOCK_MIN_ALERT_INTERVAL:
+            continue
+        # All products crossing a threshold since the last message go out together.
+        text = "📉هشدار کمبود موجودی\n\n" + "\n".join(LOW_STOCK_PENDING.values())
+        try:
+            await application.bot.send_message(chat_id=ADMIN_ID, text=text)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Low-stock alert failed: {e}")
+            continue
+        LOW_STOCK_PENDING.clear()
+        LOW_STOCK_LAST_ALERT = time.monotonic()
+
+# =====================================================================
+# Per-Product Sales Series
+# =====================================================================
+# Every sale is appended to three parallel columns (timestamp, product id,
+# price), both in memory and in one file per column under SALES_SERIES_DIR.
+SALES_TIMESTAMPS = array('q')          # epoch seconds (UTC)
+SALES_PRODUCTS = array('I')            # index into SALES_PRODUCT_NAMES
+SALES_PRICES = array('q')              # price paid
+SALES_PRODUCT_NAMES = []               # product id -> product name
+SALES_PRODUCT_IDS = {}                 # product name -> product id
+SALES_COLUMNS = (("timestamps", SALES_TIMESTAMPS), ("products", SALES_PRODUCTS), ("prices", SALES_PRICES))
+SALES_FILES = {}                       # column name -> unbuffered append handle, opened on the first sale
+
+def epoch_seconds(timestamp: datetime.datetime) -> int:
+    return int((timestamp - datetime.datetime(1970, 1, 1)).total_seconds())
+
+def from_epoch_seconds(seconds: int) -> datetime.datetime:
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+
+def sales_product_id(product: str) -> int:
+    product_id = SALES_PRODUCT_IDS.get(product)
+    if product_id is None:
+        product_id = len(SALES_PRODUCT_NAMES)
+        SALES_PRODUCT_NAMES.append(product)
+        SALES_PRODUCT_IDS[product] = product_id
+        os.makedirs(SALES_SERIES_DIR, exist_ok=True)
+        with open(os.path.join(SALES_SERIES_DIR, "products.json"), "w", encoding="utf-8") as f:
+            json.dump(SALES_PRODUCT_NAMES, f, ensure_ascii=False)
+    return product_id
+
+def sales_column_path(name: str) -> str:
+    return os.path.join(SALES_SERIES_DIR, f"{name}.bin")
+
+def record_sale(timestamp: datetime.datetime, product: str, price: int) -> None:
+    row = (epoch_seconds(timestamp), sales_product_id(product), price)
+    for (name, column), value in zip(SALES_COLUMNS, row):
+        column.append(value)
+        f = SALES_FILES.get(name)
+        if f is None:
+            # Unbuffered, so each row reaches the file as soon as it is written.
+            f = SALES_FILES[name] = open(sales_column_path(name), "ab", buffering=0)
+        f.write(column[-1:].tobytes())
+
+def close_sales_files() -> None:
+    for f in SALES_FILES.values():
+        f.close()
+    SALES_FILES.clear()
+
+def load_sales_series() -> None:
+    close_sales_files()
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            USER_BALANCES = data.get("USER_BALANCES", {})
-            USER_CHARGED = data.get("USER_CHARGED", {})
-            USER_PURCHASED = data.get("USER_PURCHASED", {})
-            USER_RECENT_PURCHASES = data.get("USER_RECENT_PURCHASES", {})
+        with open(os.path.join(SALES_SERIES_DIR, "products.json"), "r", encoding="utf-8") as f:
+            names = json.load(f)
     except FileNotFoundError:
-        USER_BALANCES = {}
-        USER_CHARGED = {}
-        USER_PURCHASED = {}
-        USER_RECENT_PURCHASES = {}
+        return
+    SALES_PRODUCT_NAMES[:] = names
+    SALES_PRODUCT_IDS.clear()
+    SALES_PRODUCT_IDS.update({name: product_id for product_id, name in enumerate(names)})
+    for name, column in SALES_COLUMNS:
+        del column[:]
+        path = sales_column_path(name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            # A crash in the middle of an append can leave part of a value at the end.
+            column.frombytes(data[:len(data) - len(data) % column.itemsize])
+    # ...or one column a row longer than the others. The files are cut back
+    # to the rows all three share, so later appends line up again.
+    rows = min(len(column) for _, column in SALES_COLUMNS)
+    for name, column in SALES_COLUMNS:
+        del column[rows:]
+        path = sales_column_path(name)
+        if os.path.exists(path) and os.path.getsize(path) != rows * column.itemsize:
+            logger.warning(f"Repairing {path}: keeping {rows} rows")
+            os.truncate(path, rows * column.itemsize)
+
+def sales_period_labels(period: str, timestamps) -> list:
+    days = [ts // 86400 for ts in timestamps]
+    if period == "daily":
+        return [str(datetime.date(1970, 1, 1) + datetime.timedelta(days=day)) for day in days]
+    if period == "weekly":
+        # Weeks start on Saturday, like current_week().
+        return [str(datetime.date(1970, 1, 1) + datetime.timedelta(days=(day + 5) // 7 * 7 - 5)) for day in days]
+    return [(datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).strftime("%Y-%m") for day in days]
+
+def sales_rollup(period: str) -> list:
+    # Returns (period label, product, units sold, revenue) rows in period order.
+    if not SALES_TIMESTAMPS:
+        return []
+    if np is not None:
+        timestamps = np.frombuffer(SALES_TIMESTAMPS, dtype=np.int64)
+        products = np.frombuffer(SALES_PRODUCTS, dtype=np.uint32).astype(np.int64)
+        prices = np.frombuffer(SALES_PRICES, dtype=np.int64)
+        if period == "monthly":
+            buckets = timestamps.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+        elif period == "weekly":
+            buckets = (timestamps // 86400 + 5) // 7
+        else:
+            buckets = timestamps // 86400
+        keys = buckets * len(SALES_PRODUCT_NAMES) + products
+        unique_keys, first_rows, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        units = np.bincount(inverse)
+        revenue = np.bincount(inverse, weights=prices)
+        labels = sales_period_labels(period, timestamps[first_rows].tolist())
+        product_ids = (unique_keys % len(SALES_PRODUCT_NAMES)).tolist()
+        return [(label, SALES_PRODUCT_NAMES[product_id], int(count), int(total))
+                for label, product_id, count, total in zip(labels, product_ids, units.tolist(), revenue.tolist())]
+    totals = {}
+    labels = sales_period_labels(period, SALES_TIMESTAMPS)
+    for label, product_id, price in zip(labels, SALES_PRODUCTS, SALES_PRICES):
+        entry = totals.setdefault((label, product_id), [0, 0])
+        entry[0] += 1
+        entry[1] += price
+    return [(label, SALES_PRODUCT_NAMES[product_id], count, total)
+            for (label, product_id), (count, total) in sorted(totals.items())]
+
+def sales_csv(period: str) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["period", "product", "units", "revenue"])
+    writer.writerows(sales_rollup(period))
+    # BOM so spreadsheet apps pick up the Persian product names as UTF-8.
+    return buffer.getvalue().encode("utf-8-sig")
+
+# =====================================================================
+# Streaming Top-K Buyers and Chargers
+# =====================================================================
+TOP_K_SIZE = 10                        # entries shown per leaderboard
+
+def current_day() -> int:
+    return day_number(datetime.datetime.utcnow())
+
+def current_week() -> int:
+    # Day 0 (1970-01-01) was a Thursday; shifting by 5 makes weeks start on Saturday.
+    return (current_day() + 5) // 7
+
+class TopK:
+    # Counts only grow within a window, so an entry outside the board can only
+    # enter by passing the current minimum; the board therefore stays exact.
+    def __init__(self, size: int):
+        self.size = size
+        self.board = {}
+
+    def offer(self, key: int, count: int) -> None:
+        if key in self.board or len(self.board) < self.size:
+            self.board[key] = count
+            return
+        lowest = min(self.board, key=self.board.get)
+        if count > self.board[lowest]:
+            del self.board[lowest]
+            self.board[key] = count
+
+    def items(self) -> list:
+        return sorted(self.board.items(), key=lambda item: item[1], reverse=True)
+
+class WindowedTopK:
+    def __init__(self, size: int, period_fn):
+        self.size = size
+        self.period_fn = period_fn
+        self.period = period_fn()
+        self.counts = {}
+        self.top = TopK(size)
+
+    def _roll(self) -> None:
+        period = self.period_fn()
+        if period != self.period:
+            self.period = period
+            self.counts = {}
+            self.top = TopK(self.size)
+
+    def add(self, key: int, amount: int) -> None:
+        self._roll()
+        count = self.counts.get(key, 0) + amount
+        self.counts[key] = count
+        self.top.offer(key, count)
+
+    def items(self) -> list:
+        self._roll()
+        return self.top.items()
+
+    def to_dict(self) -> dict:
+        return {"period": self.period, "counts": self.counts}
+
+    def restore(self, data: dict) -> None:
+        if not data or data.get("period") != self.period_fn():
+            return
+        self.period = data["period"]
+        self.counts = {int(key): count for key, count in data["counts"].items()}
+        self.top = TopK(self.size)
+        for key, count in self.counts.items():
+            self.top.offer(key, count)
+
+TOP_BUYERS = {"today": WindowedTopK(TOP_K_SIZE, current_day), "week": WindowedTopK(TOP_K_SIZE, current_week), "all": TopK(TOP_K_SIZE)}
+TOP_CHARGERS = {"today": WindowedTopK(TOP_K_SIZE, current_day), "week": WindowedTopK(TOP_K_SIZE, current_week), "all": TopK(TOP_K_SIZE)}
+TOP_K_WINDOW_TITLES = {"today": "امروز", "week": "این هفته", "all": "همه زمان‌ها"}
+
+def record_top_k(trackers: dict, user_id: int, amount: int, total: int) -> None:
+    trackers["today"].add(user_id, amount)
+    trackers["week"].add(user_id, amount)
+    trackers["all"].offer(user_id, total)
+
+def rebuild_all_time_top_k() -> None:
+    # All-time boards follow the lifetime totals, so they are seeded once at startup.
+    TOP_BUYERS["all"] = TopK(TOP_K_SIZE)
+    TOP_CHARGERS["all"] = TopK(TOP_K_SIZE)
+    for user_id, record in USERS.items():
+        if record.purchased:
+            TOP_BUYERS["all"].offer(user_id, record.purchased)
+        if record.charged:
+            TOP_CHARGERS["all"].offer(user_id, record.charged)
+
+def format_top_k(title: str, trackers: dict) -> str:
+    lines = [title]
+    for window, window_title in TOP_K_WINDOW_TITLES.items():
+        entries = trackers[window].items()
+        lines.append(f"\n🔸{window_title}:")
+        if not entries:
+            lines.append("—")
+        for rank, (user_id, count) in enumerate(entries, start=1):
+            lines.append(f"{rank}. {user_id} | {count}")
+    return "\n".join(lines)
+
+# =====================================================================
+# Audience Segment Indexes
+# =====================================================================
+# Segments are answered from these sets, which are built once at startup and
+# then updated on every purchase / balance change instead of scanning users.
+BUYERS_BY_DAY = {}                     # day number (UTC) -> set of user_ids who bought that day
+PRODUCT_BUYERS = {}                    # product name -> set of user_ids who bought it
+BUYERS = set()                         # user_ids with at least one purchase
+POSITIVE_BALANCE_USERS = set()         # user_ids whose balance is above zero
+
+BROADCAST_SEGMENTS = {
+    "all": "همه کاربران",
+    "recent7": "خریداران ۷ روز اخیر",
+    "balance": "کاربران دارای موجودی",
+    "never": "کاربرانی که خرید نکرده‌اند",
+}
+
+def set_user_balance(user_id: int, balance: int) -> None:
+    record = get_or_create_user(user_id)
+    record.balance = balance
+    sync_user_columns(user_id, record)
+    if balance > 0:
+        POSITIVE_BALANCE_USERS.add(user_id)
+    else:
+        POSITIVE_BALANCE_USERS.discard(user_id)
+
+def sync_user_columns(user_id: int, record: UserRecord) -> None:
+    if not USER_COLUMNS_ENABLED:
+        return
+    row = USER_ROWS.get(user_id)
+    if row is None:
+        USER_ROWS[user_id] = len(USER_ID_COLUMN)
+        USER_ID_COLUMN.append(user_id)
+        BALANCE_COLUMN.append(record.balance)
+        CHARGED_COLUMN.append(record.charged)
+        PURCHASED_COLUMN.append(record.purchased)
+    else:
+        BALANCE_COLUMN[row] = record.balance
+        CHARGED_COLUMN[row] = record.charged
+        PURCHASED_COLUMN[row] = record.purchased
+
+def index_purchase(user_id: int, timestamp: datetime.datetime, product: str) -> None:
+    day = day_number(timestamp)
+    if day not in BUYERS_BY_DAY:
+        for old_day in [d for d in BUYERS_BY_DAY if d <= day - SEGMENT_INDEX_DAYS]:
+            del BUYERS_BY_DAY[old_day]
+        BUYERS_BY_DAY[day] = set()
+    BUYERS_BY_DAY[day].add(user_id)
+    PRODUCT_BUYERS.setdefault(product, set()).add(user_id)
+    BUYERS.add(user_id)
+
+def rebuild_segment_indexes() -> None:
+    # PRODUCT_BUYERS is saved with the user data, since archived purchases
+    # are no longer in memory to rebuild it from; this only adds to it.
+    BUYERS_BY_DAY.clear()
+    BUYERS.clear()
+    POSITIVE_BALANCE_USERS.clear()
+    oldest_day = day_number(datetime.datetime.utcnow()) - SEGMENT_INDEX_DAYS
+    for user_id, record in USERS.items():
+        if record.purchased > 0:
+            BUYERS.add(user_id)
+        if record.balance > 0:
+            POSITIVE_BALANCE_USERS.add(user_id)
+        for entry in record.purchases or ():
+            timestamp, product = from_epoch_seconds(entry[0]), SALES_PRODUCT_NAMES[entry[1]]
+            if day_number(timestamp) > oldest_day:
+                index_purchase(user_id, timestamp, product)
+            else:
+                PRODUCT_BUYERS.setdefault(product, set()).add(user_id)
+                BUYERS.add(user_id)
+
+def segment_product_name(segment: str) -> str:
+    # Buttons carry the sales-series id, since a product name can pass Telegram's
+    # 64-byte callback_data limit; jobs saved before that carry the name.
+    product = segment.split("_", 1)[1]
+    if product.isdigit() and int(product) < len(SALES_PRODUCT_NAMES):
+        return SALES_PRODUCT_NAMES[int(product)]
+    return product
+
+def resolve_segment(segment: str) -> set:
+    if segment == "recent7":
+        today = day_number(datetime.datetime.utcnow())
+        users = set()
+        for day in range(today - 6, today + 1):
+            users |= BUYERS_BY_DAY.get(day, set())
+        return users
+    if segment == "balance":
+        return set(POSITIVE_BALANCE_USERS)
+    if segment == "never":
+        return REGISTERED_USERS - BUYERS
+    if segment.startswith("product_"):
+        return set(PRODUCT_BUYERS.get(segment_product_name(segment), set()))
+    if segment.startswith("balanceabove_"):
+        return users_with_balance_above(int(segment.split("_", 1)[1])) & REGISTERED_USERS
+    return set(REGISTERED_USERS)
+
+# =====================================================================
+# Columnar User Store
+# =====================================================================
+# A dense copy of the numeric UserRecord fields, one row per user, so fleet
+# totals and balance filters are a single pass over packed int64 columns
+# (vectorized with numpy when it is installed). USERS stays the source of
+# truth; every write goes through sync_user_columns(). Rows are never
+# removed, since users are never deleted.
+USER_ROWS = {}                         # user_id -> row in the columns below
+USER_ID_COLUMN = array('q')
+BALANCE_COLUMN = array('q')
+CHARGED_COLUMN = array('q')
+PURCHASED_COLUMN = array('q')
+
+def rebuild_user_columns() -> None:
+    USER_ROWS.clear()
+    for column in (USER_ID_COLUMN, BALANCE_COLUMN, CHARGED_COLUMN, PURCHASED_COLUMN):
+        del column[:]
+    for user_id, record in USERS.items():
+        sync_user_columns(user_id, record)
+
+def fleet_totals() -> dict:
+    if not USER_COLUMNS_ENABLED:
+        records = USERS.values()
+        return {
+            "users": len(USERS),
+            "balance": sum(record.balance for record in records),
+            "charged": sum(record.charged for record in records),
+            "purchased": sum(record.purchased for record in records),
+            "holders": sum(1 for record in records if record.balance > 0),
+        }
+    if np is not None:
+        # Views share memory with the arrays and are dropped before the next append.
+        balances = np.frombuffer(BALANCE_COLUMN, dtype=np.int64)
+        return {
+            "users": len(USER_ID_COLUMN),
+            "balance": int(balances.sum()),
+            "charged": int(np.frombuffer(CHARGED_COLUMN, dtype=np.int64).sum()),
+            "purchased": int(np.frombuffer(PURCHASED_COLUMN, dtype=np.int64).sum()),
+            "holders": int(np.count_nonzero(balances > 0)),
+        }
+    return {
+        "users": len(USER_ID_COLUMN),
+        "balance": sum(BALANCE_COLUMN),
+        "charged": sum(CHARGED_COLUMN),
+        "purchased": sum(PURCHASED_COLUMN),
+        "holders": sum(1 for balance in BALANCE_COLUMN if balance > 0),
+    }
+
+def users_with_balance_above(threshold: int) -> set:
+    if not USER_COLUMNS_ENABLED:
+        return {user_id for user_id, record in USERS.items() if record.balance > threshold}
+    if np is not None:
+        balances = np.frombuffer(BALANCE_COLUMN, dtype=np.int64)
+        user_ids = np.frombuffer(USER_ID_COLUMN, dtype=np.int64)
+        return set(user_ids[balances > threshold].tolist())
+    return {user_id for user_id, balance in zip(USER_ID_COLUMN, BALANCE_COLUMN) if balance > threshold}
+
+def get_segment_title(segment: str) -> str:
+    if segment.startswith("product_"):
+        return f"خریداران {segment_product_name(segment)}"
+    if segment.startswith("balanceabove_"):
+        return f"کاربران با موجودی بیشتر از {segment.split('_', 1)[1]}"
+    return BROADCAST_SEGMENTS.get(segment, BROADCAST_SEGMENTS["all"])
+
+def get_broadcast_segment_keyboard():
+    keyboard = [[InlineKeyboardButton(title, callback_data=f"segment_{key}")]
+                for key, title in BROADCAST_SEGMENTS.items()]
+    for threshold in BALANCE_SEGMENT_THRESHOLDS:
+        keyboard.append([InlineKeyboardButton(get_segment_title(f"balanceabove_{threshold}"),
+                                              callback_data=f"segment_balanceabove_{threshold}")])
+    for product in PRODUCT_PRICES.keys():
+        keyboard.append([InlineKeyboardButton(f"خریداران {product}",
+                                              callback_data=f"segment_product_{sales_product_id(product)}")])
+    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
+    return InlineKeyboardMarkup(keyboard)
 
 # =====================================================================
 # Membership Check Function
@@ -197,7 +1540,10 @@ def get_admin_panel_keyboard():
          InlineKeyboardButton("🪙بالا بردن قیمت ها", callback_data="admin_increase_price")],
         [InlineKeyboardButton("🟢روشن کردن ربات", callback_data="admin_turn_on_bot"),
          InlineKeyboardButton("🔴خاموش کردن ربات", callback_data="admin_turn_off_bot")],
-        [InlineKeyboardButton("📊آمار", callback_data="admin_stats")],
+        [InlineKeyboardButton("📊آمار", callback_data="admin_stats"),
+         InlineKeyboardButton("🏆کاربران برتر", callback_data="admin_top_users")],
+        [InlineKeyboardButton("📦موجودی محصولات", callback_data="admin_inventory"),
+         InlineKeyboardButton("💰گزارش فروش", callback_data="admin_sales_report")],
         [InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -226,6 +1572,348 @@ def get_product_purchase_keyboard():
     buttons.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
     return InlineKeyboardMarkup(buttons)
 
+# =====================================================================
+# Broadcast Engine
+# =====================================================================
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        # Flood control applies to the whole bot, so every sender waits it out.
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, count: int = 1) -> None:
+        # A request larger than the bucket waits for a full bucket instead of forever.
+        count = min(count, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                await asyncio.sleep((count - self.tokens) / self.rate)
+
+BROADCAST_BUCKET = TokenBucket(BROADCAST_GLOBAL_RATE, BROADCAST_GLOBAL_RATE)
+CHAT_LAST_SENT = {}                    # chat_id -> monotonic time of the last broadcast send
+
+async def wait_chat_slot(chat_id: int) -> None:
+    now = time.monotonic()
+    ready_at = CHAT_LAST_SENT.get(chat_id, 0.0) + BROADCAST_PER_CHAT_INTERVAL
+    CHAT_LAST_SENT[chat_id] = max(now, ready_at)
+    if ready_at > now:
+        await asyncio.sleep(ready_at - now)
+
+def prune_chat_slots() -> None:
+    # An entry only matters until its chat's interval has passed; without
+    # this every recipient of every broadcast would stay in the dict.
+    cutoff = time.monotonic() - BROADCAST_PER_CHAT_INTERVAL
+    for chat_id in [chat_id for chat_id, sent in CHAT_LAST_SENT.items() if sent <= cutoff]:
+        del CHAT_LAST_SENT[chat_id]
+
+def retry_after_seconds(error: telegram.error.RetryAfter) -> float:
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+def is_dead_recipient_error(error: telegram.error.TelegramError) -> bool:
+    if isinstance(error, telegram.error.Forbidden):
+        return True
+    return isinstance(error, telegram.error.BadRequest) and "chat not found" in str(error).lower()
+
+def mark_user_dead(user_id: int, reason: str) -> None:
+    DEAD_USERS[user_id] = reason
+
+def get_broadcast_audience(segment: str = "all") -> list:
+    return sorted(user for user in resolve_segment(segment) if user not in DEAD_USERS)
+
+# Media is referenced by the file_id Telegram assigned when the admin uploaded it,
+# so every recipient reuses the stored file instead of receiving a new upload.
+BROADCAST_CONTENT_FILTER = (filters.TEXT & ~filters.COMMAND) | filters.PHOTO | filters.VIDEO | filters.Document.ALL
+
+INPUT_MEDIA_TYPES = {
+    "photo": InputMediaPhoto,
+    "document": InputMediaDocument,
+    "video": InputMediaVideo,
+}
+
+def extract_broadcast_item(message) -> dict:
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id, "caption": message.caption}
+    if message.video:
+        return {"type": "video", "file_id": message.video.file_id, "caption": message.caption}
+    if message.document:
+        return {"type": "document", "file_id": message.document.file_id, "caption": message.caption}
+    return {"type": "text", "text": message.text.strip()}
+
+async def deliver_broadcast_payload(bot, chat_id: int, payload: dict) -> None:
+    kind = payload["type"]
+    if kind == "text":
+        await bot.send_message(chat_id=chat_id, text=payload["text"])
+    elif kind == "photo":
+        await bot.send_photo(chat_id=chat_id, photo=payload["file_id"], caption=payload.get("caption"))
+    elif kind == "video":
+        await bot.send_video(chat_id=chat_id, video=payload["file_id"], caption=payload.get("caption"))
+    elif kind == "document":
+        await bot.send_document(chat_id=chat_id, document=payload["file_id"], caption=payload.get("caption"))
+    elif kind == "album":
+        media = [INPUT_MEDIA_TYPES[item["type"]](media=item["file_id"], caption=item.get("caption"))
+                 for item in payload["items"]]
+        await bot.send_media_group(chat_id=chat_id, media=media)
+
+def broadcast_message_count(payload: dict) -> int:
+    # Telegram counts every item of an album against the bot's rate limit.
+    return len(payload["items"]) if payload["type"] == "album" else 1
+
+def album_mixes_documents(items: list) -> bool:
+    # sendMediaGroup groups documents only with other documents.
+    kinds = {item["type"] == "document" for item in items}
+    return len(kinds) > 1
+
+def get_job_payload(job: dict) -> dict:
+    # Jobs created before media support only stored the text.
+    return job.get("payload") or {"type": "text", "text": job["text"]}
+
+# Returns "sent", "failed" or "dead" (blocked the bot / chat no longer exists).
+async def send_broadcast_message(bot, chat_id: int, payload: dict) -> str:
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await BROADCAST_BUCKET.acquire(broadcast_message_count(payload))
+        await wait_chat_slot(chat_id)
+        try:
+            await deliver_broadcast_payload(bot, chat_id, payload)
+            return "sent"
+        except telegram.error.RetryAfter as e:
+            delay = retry_after_seconds(e)
+            logger.warning(f"Flood control during broadcast, waiting {delay}s")
+            BROADCAST_BUCKET.pause(delay)
+            await asyncio.sleep(delay)
+        except (telegram.error.BadRequest, telegram.error.Forbidden) as e:
+            if is_dead_recipient_error(e):
+                mark_user_dead(chat_id, str(e))
+                return "dead"
+            logger.info(f"خطا در ارسال پیام به کاربر {chat_id}: {e}")
+            return "failed"
+        except telegram.error.NetworkError:
+            await asyncio.sleep(2 ** attempt)
+        except telegram.error.TelegramError as e:
+            logger.info(f"خطا در ارسال پیام به کاربر {chat_id}: {e}")
+            return "failed"
+    return "failed"
+
+def format_broadcast_progress(job: dict) -> str:
+    titles = {
+        "running": "📧در حال ارسال پیام همگانی...",
+        "paused": "⏸ارسال پیام همگانی متوقف شد",
+        "cancelled": "🚫ارسال پیام همگانی لغو شد",
+        "done": "✅ارسال پیام همگانی به پایان رسید",
+    }
+    remaining = job["total"] - job["sent"] - job["failed"]
+    return (f"{titles[job['status']]} (#{job['id']})\n"
+            f"👥 مخاطبان: {get_segment_title(job.get('segment', 'all'))}\n\n"
+            f"✅ ارسال شده: {job['sent']}\n"
+            f"❌ ناموفق: {job['failed']}\n"
+            f"🚫 مسدودکرده/حذف‌شده: {job.get('dead', 0)}\n"
+            f"⏳ باقی‌مانده: {remaining}")
+
+async def edit_progress_message(bot, chat_id: int, message_id: int, text: str) -> None:
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+    except telegram.error.BadRequest as error:
+        if "Message is not modified" not in str(error):
+            logger.warning(f"Broadcast progress update failed: {error}")
+    except telegram.error.TelegramError as error:
+        logger.warning(f"Broadcast progress update failed: {error}")
+
+# =====================================================================
+# Persistent Broadcast Jobs
+# =====================================================================
+BROADCAST_JOBS = {}                    # job_id -> job state (cursor, counters, status)
+BROADCAST_RECIPIENTS = {}              # job_id -> sorted recipient list
+BROADCAST_TASKS = {}                   # job_id -> running asyncio task
+
+def broadcast_job_path(job_id: str, suffix: str) -> str:
+    return os.path.join(BROADCAST_JOBS_DIR, f"{job_id}.{suffix}")
+
+def save_broadcast_job(job: dict) -> None:
+    os.makedirs(BROADCAST_JOBS_DIR, exist_ok=True)
+    tmp_path = broadcast_job_path(job["id"], "json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, broadcast_job_path(job["id"], "json"))
+
+def create_broadcast_job(payload: dict, recipients: list, admin_chat_id: int, segment: str = "all") -> dict:
+    job_id = str(int(time.time() * 1000))
+    job = {
+        "id": job_id,
+        "payload": payload,
+        "segment": segment,
+        "admin_chat_id": admin_chat_id,
+        "status_message_id": None,
+        "status": "running",
+        "cursor": 0,
+        "total": len(recipients),
+        "sent": 0,
+        "failed": 0,
+        "dead": 0,
+    }
+    # The recipient list is written once; checkpoints only rewrite the small job file.
+    os.makedirs(BROADCAST_JOBS_DIR, exist_ok=True)
+    with open(broadcast_job_path(job_id, "recipients"), "w", encoding="utf-8") as f:
+        f.write("\n".join(str(user) for user in recipients))
+    save_broadcast_job(job)
+    BROADCAST_JOBS[job_id] = job
+    BROADCAST_RECIPIENTS[job_id] = recipients
+    return job
+
+def load_broadcast_jobs() -> None:
+    if not os.path.isdir(BROADCAST_JOBS_DIR):
+        return
+    for name in os.listdir(BROADCAST_JOBS_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(BROADCAST_JOBS_DIR, name), "r", encoding="utf-8") as f:
+                job = json.load(f)
+            recipients = []
+            if job["status"] in ("running", "paused"):
+                with open(broadcast_job_path(job["id"], "recipients"), "r", encoding="utf-8") as f:
+                    recipients = [int(line) for line in f if line.strip()]
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Could not load broadcast job {name}: {e}")
+            continue
+        BROADCAST_JOBS[job["id"]] = job
+        BROADCAST_RECIPIENTS[job["id"]] = recipients
+
+def start_broadcast_job(application: Application, job: dict) -> None:
+    job["status"] = "running"
+    # Not application.create_task(): Application.stop() would wait for the whole
+    # broadcast. on_stop() cancels these instead, and they resume from their checkpoint.
+    task = asyncio.create_task(run_broadcast(application.bot, job))
+    task.add_done_callback(log_broadcast_failure)
+    BROADCAST_TASKS[job["id"]] = task
+
+def log_broadcast_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Broadcast job failed", exc_info=task.exception())
+
+async def run_broadcast(bot, job: dict) -> None:
+    recipients = BROADCAST_RECIPIENTS[job["id"]]
+    payload = get_job_payload(job)
+    admin_chat_id = job["admin_chat_id"]
+    pending = iter(range(job["cursor"], len(recipients)))
+    completed = set()
+    since_checkpoint = 0
+
+    async def worker():
+        nonlocal since_checkpoint
+        # The status is checked before taking an index, so a paused job leaves
+        # no index taken but unsent behind the cursor.
+        while job["status"] == "running":
+            index = next(pending, None)
+            if index is None:
+                return
+            user = recipients[index]
+            # Users found unreachable since the job was created are skipped without an API call.
+            result = "dead" if user in DEAD_USERS else await send_broadcast_message(bot, user, payload)
+            if result == "sent":
+                job["sent"] += 1
+            else:
+                job["failed"] += 1
+                if result == "dead":
+                    job["dead"] = job.get("dead", 0) + 1
+            # The cursor only moves past a contiguous run of finished sends, so a
+            # restart re-sends at most the sends after the last checkpoint.
+            completed.add(index)
+            while job["cursor"] in completed:
+                completed.remove(job["cursor"])
+                job["cursor"] += 1
+            since_checkpoint += 1
+            if since_checkpoint >= BROADCAST_CHECKPOINT_EVERY:
+                since_checkpoint = 0
+                save_broadcast_job(job)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            prune_chat_slots()
+            await edit_progress_message(bot, admin_chat_id, job["status_message_id"], format_broadcast_progress(job))
+
+    reporter_task = None
+    try:
+        if job["status_message_id"] is None:
+            try:
+                status = await bot.send_message(chat_id=admin_chat_id, text=format_broadcast_progress(job))
+            except telegram.error.TelegramError as e:
+                # Left paused so the admin can /bresume it once Telegram answers again.
+                logger.error(f"Could not start broadcast job {job['id']}: {e}")
+                job["status"] = "paused"
+                return
+            job["status_message_id"] = status.message_id
+        save_broadcast_job(job)
+        reporter_task = asyncio.create_task(reporter())
+        await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    finally:
+        if reporter_task is not None:
+            reporter_task.cancel()
+        if job["status"] == "running" and job["cursor"] >= len(recipients):
+            job["status"] = "done"
+        save_broadcast_job(job)
+        BROADCAST_TASKS.pop(job["id"], None)
+        prune_chat_slots()
+        if job.get("dead"):
+            schedule_user_data_save()
+    if job["status_message_id"] is None:
+        return
+    await edit_progress_message(bot, admin_chat_id, job["status_message_id"], format_broadcast_progress(job))
+
+# Endless background loops. Like broadcasts they are not started with
+# application.create_task(): PTB does not track tasks created in post_init,
+# and on_stop() must end them before on_shutdown() writes the final save.
+WORKER_TASKS = set()
+
+def start_worker(coroutine) -> None:
+    WORKER_TASKS.add(asyncio.create_task(coroutine))
+
+async def on_startup(application: Application) -> None:
+    await resume_broadcast_jobs(application)
+    start_worker(low_stock_watcher(application))
+    start_worker(purchase_retention_worker())
+    start_worker(backup_worker(application))
+    start_worker(user_context_cleanup_worker(application))
+
+async def on_stop(application: Application) -> None:
+    # Running broadcasts stop where their workers are and keep the "running"
+    # status, so the next start resumes them from the saved cursor.
+    tasks = list(BROADCAST_TASKS.values()) + list(WORKER_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    WORKER_TASKS.clear()
+    await asyncio.gather(*BACKUP_RUNS, return_exceptions=True)
+
+async def on_shutdown(application: Application) -> None:
+    # Changes still waiting for their group save are written before exit.
+    async with SAVE_LOCK:
+        save_user_data()
+
+async def resume_broadcast_jobs(application: Application) -> None:
+    load_broadcast_jobs()
+    for job in BROADCAST_JOBS.values():
+        if job["status"] == "running":
+            logger.info(f"Resuming broadcast job {job['id']} at {job['cursor']}/{job['total']}")
+            start_broadcast_job(application, job)
+
 # =====================================================================
 # User Handlers
 # =====================================================================
@@ -241,7 +1929,9 @@ async def banned_check_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    REGISTERED_USERS.add(user_id)
+    register_user(user_id)
+    # A user who unblocked the bot and pressed /start is reachable again.
+    DEAD_USERS.pop(user_id, None)
     if not BOT_ACTIVE:
         await update.message.reply_text("ربات خاموش است❌")
         return
@@ -274,33 +1964,39 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if product not in SERVICE_CODES or not SERVICE_CODES[product]:
         await query.edit_message_text(text="کد موجود نمی‌باشد❌", reply_markup=get_inline_main_menu())
         return
-    balance = USER_BALANCES.get(user_id, 0)
+    record = get_user(user_id)
+    balance = record.balance
     price = PRODUCT_PRICES.get(product, 30000)
     if balance < price:
         await query.edit_message_text(text="موجودی شما کافی نیست❌", reply_markup=get_inline_main_menu())
         return
-    USER_BALANCES[user_id] = balance - price
+    set_user_balance(user_id, balance - price)
     now = datetime.datetime.utcnow()
-    USER_RECENT_PURCHASES.setdefault(user_id, []).append((now, product))
-    USER_PURCHASED[user_id] = USER_PURCHASED.get(user_id, 0) + 1
+    record_purchase(user_id, (epoch_seconds(now), sales_product_id(product), price))
+    record_sale(now, product, price)
+    index_purchase(user_id, now, product)
+    SALES_COUNTER.add(1)
+    record = get_or_create_user(user_id)
+    record.purchased += 1
+    sync_user_columns(user_id, record)
+    record_top_k(TOP_BUYERS, user_id, 1, record.purchased)
     code = SERVICE_CODES[product].pop(0)
+    record_inventory_sale(product)
     if not SERVICE_CODES[product]:
         await context.bot.send_message(chat_id=ADMIN_ID,
             text=f"❌کدهای سرویس {product} تمام شده‌اند؛ لطفاً کدها را شارژ کنید.")
     message = f"🛍کد تخفیف شما آماده شد 🤩\n\n🛍کد: {code}"
     await query.edit_message_text(text=message, reply_markup=get_inline_main_menu())
     # Save current user data persistently
-    save_user_data()
+    schedule_user_data_save()
 
 async def user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    balance = USER_BALANCES.get(user_id, 0)
-    charged = USER_CHARGED.get(user_id, 0)
-    purchased = USER_PURCHASED.get(user_id, 0)
+    record = get_user(user_id)
     msg = (f"🪪 شناسه حساب : {user_id}\n"
-           f"💳 مبلغ شارژ شده تا الان : {charged}\n"
-           f"🌐 تعداد کدهای خریداری شده : {purchased}\n"
-           f"💰 موجودی شما : {balance}")
+           f"💳 مبلغ شارژ شده تا الان : {record.charged}\n"
+           f"🌐 تعداد کدهای خریداری شده : {record.purchased}\n"
+           f"💰 موجودی شما : {record.balance}")
     await update.message.reply_text(msg, reply_markup=get_user_profile_keyboard())
 
 async def charge_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -394,8 +2090,9 @@ async def admin_receive_button_price(update: Update, context: ContextTypes.DEFAU
     PRODUCT_PRICES[button_name] = price
     SERVICE_CODES[button_name] = []
     SERVICE_FILE_PATH[button_name] = ""
+    restock_inventory(button_name, 0)
     await update.message.reply_text(f"دکمه '{button_name}' با قیمت {price} اضافه شد.", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
     return ConversationHandler.END
 
 # =====================================================================
@@ -425,10 +2122,11 @@ async def admin_remove_button_select(update: Update, context: ContextTypes.DEFAU
         del PRODUCT_PRICES[product]
     if product in SERVICE_CODES:
         del SERVICE_CODES[product]
+    INVENTORY.pop(product, None)
     if product in SERVICE_FILE_PATH:
         del SERVICE_FILE_PATH[product]
     await query.edit_message_text(f"دکمه '{product}' حذف شد.", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
     return ConversationHandler.END
 
 # =====================================================================
@@ -451,13 +2149,13 @@ async def admin_increase_select(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     product = query.data.split("_", 1)[1]
-    context.user_data["target_product"] = product
+    context.user_data["increase_product"] = product
     current_price = PRODUCT_PRICES.get(product, 0)
     await query.edit_message_text(f"نام محصول: {product}\nقیمت فعلی: {current_price}\nلطفاً قیمت جدید را وارد کنید:", reply_markup=get_inline_main_menu())
     return INCREASE_PRODUCT_INPUT
 
 async def admin_increase_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    product = context.user_data.get("target_product", "")
+    product = context.user_data.get("increase_product", "")
     text = update.message.text.strip()
     if not text.isdigit():
         await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید!")
@@ -465,7 +2163,7 @@ async def admin_increase_input(update: Update, context: ContextTypes.DEFAULT_TYP
     new_price = int(text)
     PRODUCT_PRICES[product] = new_price
     await update.message.reply_text(f"قیمت {product} به {new_price} تغییر یافت.", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
     return ConversationHandler.END
 
 # =====================================================================
@@ -488,13 +2186,13 @@ async def admin_decrease_select(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     product = query.data.split("_", 1)[1]
-    context.user_data["target_product"] = product
+    context.user_data["decrease_product"] = product
     current_price = PRODUCT_PRICES.get(product, 0)
     await query.edit_message_text(f"نام محصول: {product}\nقیمت فعلی: {current_price}\nلطفاً قیمت جدید را وارد کنید:", reply_markup=get_inline_main_menu())
     return DECREASE_PRODUCT_INPUT
 
 async def admin_decrease_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    product = context.user_data.get("target_product", "")
+    product = context.user_data.get("decrease_product", "")
     text = update.message.text.strip()
     if not text.isdigit():
         await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید!")
@@ -502,7 +2200,7 @@ async def admin_decrease_input(update: Update, context: ContextTypes.DEFAULT_TYP
     new_price = int(text)
     PRODUCT_PRICES[product] = new_price
     await update.message.reply_text(f"قیمت {product} به {new_price} تغییر یافت.", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
     return ConversationHandler.END
 
 # =====================================================================
@@ -541,8 +2239,9 @@ async def admin_delete_code_input(update: Update, context: ContextTypes.DEFAULT_
     if input_path == stored_path:
         SERVICE_CODES[product] = []
         del SERVICE_FILE_PATH[product]
+        restock_inventory(product, 0)
         await update.message.reply_text("کدهای سرویس حذف شدند✅", reply_markup=get_admin_panel_keyboard())
-        save_user_data()
+        schedule_user_data_save()
     else:
         await update.message.reply_text("مسیر وارد شده مطابقت ندارد.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
@@ -576,16 +2275,20 @@ async def admin_add_credit_userid(update: Update, context: ContextTypes.DEFAULT_
         return ADMIN_ADD_USERID
     target_id = int(text)
     amount = context.user_data.get("admin_credit_amount", 0)
-    new_balance = USER_BALANCES.get(target_id, 0) + amount
-    USER_BALANCES[target_id] = new_balance
-    USER_CHARGED[target_id] = USER_CHARGED.get(target_id, 0) + amount
+    record = get_or_create_user(target_id)
+    new_balance = record.balance + amount
+    set_user_balance(target_id, new_balance)
+    record.charged += amount
+    sync_user_columns(target_id, record)
+    CHARGE_COUNTER.add(amount)
+    record_top_k(TOP_CHARGERS, target_id, amount, record.charged)
     try:
         await context.bot.send_message(chat_id=target_id,
             text=f"موجودی شما به مبلغ {amount} شارژ شد. موجودی جدید: {new_balance}")
     except Exception as e:
         await update.message.reply_text(f"خطا در ارسال پیام به کاربر: {e}")
     await update.message.reply_text("اعتبار کاربر اضافه شد.", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
     return ConversationHandler.END
 
 async def admin_subtract_credit_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -614,15 +2317,15 @@ async def admin_subtract_credit_userid(update: Update, context: ContextTypes.DEF
         return ADMIN_SUB_USERID
     target_id = int(text)
     amount = context.user_data.get("admin_sub_amount", 0)
-    new_balance = USER_BALANCES.get(target_id, 0) - amount
-    USER_BALANCES[target_id] = new_balance
+    new_balance = get_user(target_id).balance - amount
+    set_user_balance(target_id, new_balance)
     try:
         await context.bot.send_message(chat_id=target_id,
             text=f"موجودی شما به مبلغ {amount} کاهش یافت. موجودی جدید: {new_balance}")
     except Exception as e:
         await update.message.reply_text(f"خطا در ارسال پیام به کاربر: {e}")
     await update.message.reply_text("اعتبار کسر شد.", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
     return ConversationHandler.END
 
 async def admin_unblock_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -647,7 +2350,7 @@ async def admin_unblock_userid(update: Update, context: ContextTypes.DEFAULT_TYP
         except Exception as e:
             await update.message.reply_text(f"خطا: {e}")
         await update.message.reply_text("کاربر آزاد شد.", reply_markup=get_admin_panel_keyboard())
-        save_user_data()
+        schedule_user_data_save()
     else:
         await update.message.reply_text("کاربر مسدود نیست.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
@@ -673,7 +2376,7 @@ async def admin_ban_userid(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     except Exception as e:
         await update.message.reply_text(f"خطا: {e}")
     await update.message.reply_text("کاربر بن شد.", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
     return ConversationHandler.END
 
 async def admin_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -724,13 +2427,11 @@ async def admin_balance_userid(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("لطفاً آیدی عددی معتبر وارد کنید!")
         return ADMIN_BALANCE_USERID
     target_id = int(text)
-    charged = USER_CHARGED.get(target_id, 0)
-    balance = USER_BALANCES.get(target_id, 0)
-    purchased = USER_PURCHASED.get(target_id, 0)
+    record = get_user(target_id)
     msg = (f"آیدی کاربر: {target_id}\n"
-           f"مبلغ شارژ شده: {charged}\n"
-           f"موجودی فعلی: {balance}\n"
-           f"تعداد خریدها: {purchased}")
+           f"مبلغ شارژ شده: {record.charged}\n"
+           f"موجودی فعلی: {record.balance}\n"
+           f"تعداد خریدها: {record.purchased}")
     await update.message.reply_text(msg, reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
 
@@ -749,39 +2450,194 @@ async def admin_recent_purchases_userid(update: Update, context: ContextTypes.DE
         await update.message.reply_text("لطفاً آیدی عددی معتبر وارد کنید!")
         return ADMIN_RECENT_PURCHASES_USERID
     target_id = int(text)
-    now = datetime.datetime.utcnow()
-    week_ago = now - datetime.timedelta(days=7)
-    purchases = USER_RECENT_PURCHASES.get(target_id, [])
-    recent = [str(product) for (timestamp, product) in purchases if timestamp >= week_ago]
-    msg = f"خریدهای اخیر (۷ روز):\n" + ("\n".join(recent) if recent else "هیچ خریدی ثبت نشده است.")
-    await update.message.reply_text(msg, reply_markup=get_admin_panel_keyboard())
+    week_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+    msg, keyboard = format_purchase_page(target_id, purchases_since(target_id, week_ago), 0)
+    await update.message.reply_text(msg, reply_markup=keyboard)
     return ConversationHandler.END
 
+async def admin_purchase_archive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("شما به این بخش دسترسی ندارید.")
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("استفاده: /purchase_archive <آیدی کاربر> [تعداد روز]")
+        return
+    target_id = int(context.args[0])
+    days = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else 90
+    until = datetime.datetime.utcnow()
+    # Purchases evicted since the last save reach the archive only with a save.
+    await commit_user_data()
+    rows = await asyncio.to_thread(query_purchase_archive, target_id, until - datetime.timedelta(days=days), until)
+    archived = [(timestamp, sales_product_id(product), *rest) for timestamp, product, *rest in rows]
+    lines = [format_purchase_entry(entry) for entry in archived[-PURCHASES_PAGE_SIZE:]]
+    msg = (f"خریدهای بایگانی‌شده کاربر {target_id} ({days} روز اخیر): {len(archived)} خرید\n" +
+           ("\n".join(lines) if lines else "هیچ خریدی در بایگانی یافت نشد."))
+    await update.message.reply_text(msg)
+
+async def admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("شما به این بخش دسترسی ندارید.")
+        return
+    await update.message.reply_text("⏳پشتیبان‌گیری در پس‌زمینه شروع شد...")
+    context.application.create_task(run_backup(context.bot, update.effective_chat.id))
+
+async def admin_fleet_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("شما به این بخش دسترسی ندارید.")
+        return
+    totals = fleet_totals()
+    msg = (f"👥تعداد کاربران: {totals['users']}\n"
+           f"💰مجموع موجودی کاربران: {totals['balance']}\n"
+           f"💳مجموع مبالغ شارژ شده: {totals['charged']}\n"
+           f"🎟مجموع کدهای خریداری شده: {totals['purchased']}\n"
+           f"🔹کاربران دارای موجودی: {totals['holders']}")
+    if context.args and context.args[0].isdigit():
+        threshold = int(context.args[0])
+        msg += f"\n🔸کاربران با موجودی بیشتر از {threshold}: {len(users_with_balance_above(threshold))}"
+    await update.message.reply_text(msg)
+
+async def admin_recent_purchases_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        return
+    _, target_id, page = query.data.split("_")
+    week_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+    msg, keyboard = format_purchase_page(int(target_id), purchases_since(int(target_id), week_ago), int(page))
+    await query.edit_message_text(msg, reply_markup=keyboard)
+
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     if query.from_user.id != ADMIN_ID:
         await query.edit_message_text("دسترسی ندارید.")
         return ConversationHandler.END
-    await query.edit_message_text("لطفاً پیام همگانی را وارد کنید:")
+    await query.edit_message_text("مخاطبان پیام همگانی را انتخاب کنید:", reply_markup=get_broadcast_segment_keyboard())
+    return ADMIN_BROADCAST_SEGMENT
+
+async def admin_broadcast_segment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    segment = query.data.split("_", 1)[1]
+    context.user_data["broadcast_segment"] = segment
+    audience_size = len(get_broadcast_audience(segment))
+    await query.edit_message_text(f"مخاطبان: {get_segment_title(segment)} ({audience_size} کاربر)\n"
+                                  "لطفاً پیام همگانی (متن، عکس، ویدیو، فایل یا آلبوم) را ارسال کنید:")
     return ADMIN_BROADCAST_MESSAGE
 
 async def admin_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    msg = update.message.text.strip()
-    for user in REGISTERED_USERS:
-        try:
-            await context.bot.send_message(chat_id=user, text=msg)
-        except Exception as e:
-            logger.error(f"خطا در ارسال پیام به کاربر {user}: {e}")
-    await update.message.reply_text("پیام با موفقیت ارسال شد.", reply_markup=get_admin_panel_keyboard())
+    item = extract_broadcast_item(update.message)
+    if update.message.media_group_id:
+        # Album items arrive as separate messages; collect them until the admin confirms.
+        context.user_data["broadcast_album"] = [item]
+        context.user_data["broadcast_album_id"] = update.message.media_group_id
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ارسال آلبوم", callback_data="album_send")]])
+        await update.message.reply_text("آلبوم دریافت شد. پس از آپلود همه فایل‌ها دکمه ارسال را بزنید.", reply_markup=keyboard)
+        return ADMIN_BROADCAST_ALBUM
+    await start_admin_broadcast(update.message, context, item)
+    return ConversationHandler.END
+
+async def admin_broadcast_album_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.message.media_group_id == context.user_data.get("broadcast_album_id"):
+        context.user_data["broadcast_album"].append(extract_broadcast_item(update.message))
+    return ADMIN_BROADCAST_ALBUM
+
+async def admin_broadcast_album_send(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    items = context.user_data.pop("broadcast_album", [])
+    # Items of this album still uploading when the conversation ends are
+    # dropped by drop_late_album_item() instead of reaching other handlers.
+    context.user_data["broadcast_album_closed"] = context.user_data.pop("broadcast_album_id", None)
+    if len(items) > BROADCAST_ALBUM_MAX_ITEMS or album_mixes_documents(items):
+        context.user_data.pop("broadcast_segment", None)
+        if len(items) > BROADCAST_ALBUM_MAX_ITEMS:
+            error = f"آلبوم حداکثر {BROADCAST_ALBUM_MAX_ITEMS} فایل می‌تواند داشته باشد ({len(items)} فایل دریافت شد)."
+        else:
+            error = "فایل‌ها را نمی‌توان با عکس یا ویدیو در یک آلبوم فرستاد."
+        await query.message.reply_text(f"{error} لطفاً دوباره تلاش کنید.", reply_markup=get_admin_panel_keyboard())
+        return ConversationHandler.END
+    # sendMediaGroup needs at least two items; a single one goes out as a normal message.
+    payload = items[0] if len(items) == 1 else {"type": "album", "items": items}
+    await start_admin_broadcast(query.message, context, payload)
     return ConversationHandler.END
 
+async def drop_late_album_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.media_group_id is None or update.message.media_group_id != context.user_data.get("broadcast_album_closed"):
+        return
+    await update.message.reply_text("این فایل پس از ارسال آلبوم رسید و در پیام همگانی نیامد.")
+    raise ApplicationHandlerStop
+
+async def start_admin_broadcast(message, context: ContextTypes.DEFAULT_TYPE, payload: dict) -> None:
+    segment = context.user_data.pop("broadcast_segment", "all")
+    recipients = get_broadcast_audience(segment)
+    job = create_broadcast_job(payload, recipients, message.chat_id, segment)
+    # Sending runs in the background so the admin conversation is released right away.
+    start_broadcast_job(context.application, job)
+    await message.reply_text(
+        f"ارسال پیام همگانی #{job['id']} برای {len(recipients)} کاربر آغاز شد.\n"
+        f"توقف: /bpause {job['id']}\nادامه: /bresume {job['id']}\nلغو: /bcancel {job['id']}",
+        reply_markup=get_admin_panel_keyboard())
+
+# ------------------- Commands for Managing Broadcast Jobs -------------------
+async def admin_broadcast_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("شما به این بخش دسترسی ندارید.")
+        return
+    if not BROADCAST_JOBS:
+        await update.message.reply_text("هیچ پیام همگانی ثبت نشده است.")
+        return
+    lines = [format_broadcast_progress(job) for job in BROADCAST_JOBS.values()]
+    await update.message.reply_text("\n\n".join(lines))
+
+async def get_broadcast_job_arg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("شما به این بخش دسترسی ندارید.")
+        return None
+    job = BROADCAST_JOBS.get(context.args[0]) if context.args else None
+    if job is None:
+        await update.message.reply_text("شناسه پیام همگانی نامعتبر است.")
+    return job
+
+async def admin_broadcast_pause(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    job = await get_broadcast_job_arg(update, context)
+    if job is None:
+        return
+    if job["status"] != "running":
+        await update.message.reply_text("این پیام همگانی در حال ارسال نیست.")
+        return
+    job["status"] = "paused"
+    save_broadcast_job(job)
+    await update.message.reply_text(f"پیام همگانی #{job['id']} متوقف شد.")
+
+async def admin_broadcast_resume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    job = await get_broadcast_job_arg(update, context)
+    if job is None:
+        return
+    if job["status"] != "paused" or job["id"] in BROADCAST_TASKS:
+        await update.message.reply_text("این پیام همگانی قابل ادامه نیست.")
+        return
+    start_broadcast_job(context.application, job)
+    await update.message.reply_text(f"ارسال پیام همگانی #{job['id']} ادامه یافت.")
+
+async def admin_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    job = await get_broadcast_job_arg(update, context)
+    if job is None:
+        return
+    if job["status"] in ("done", "cancelled"):
+        await update.message.reply_text("این پیام همگانی قبلاً به پایان رسیده است.")
+        return
+    job["status"] = "cancelled"
+    save_broadcast_job(job)
+    await update.message.reply_text(f"پیام همگانی #{job['id']} لغو شد.")
+
 # ------------------- Handlers for Bot Control Buttons -------------------
 async def admin_turn_off_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     global BOT_ACTIVE
     BOT_ACTIVE = False
     query = update.callback_query
     await query.answer()
+    schedule_user_data_save()
     await query.edit_message_text("ربات خاموش شد❌", reply_markup=get_admin_panel_keyboard())
 
 async def admin_turn_on_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -789,37 +2645,80 @@ async def admin_turn_on_bot(update: Update, context: ContextTypes.DEFAULT_TYPE)
     BOT_ACTIVE = True
     query = update.callback_query
     await query.answer()
+    schedule_user_data_save()
     await query.edit_message_text("ربات روشن شد✅", reply_markup=get_admin_panel_keyboard())
 
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    now = datetime.datetime.utcnow()
-    week_ago = now - datetime.timedelta(days=7)
-    total_codes_sold = 0
-    total_charge = 0
-    highest_charge = 0
-    top_buyer_id = None
-    top_buyer_count = 0
-    for user, purchases in USER_RECENT_PURCHASES.items():
-        count = sum(1 for (timestamp, _) in purchases if timestamp >= week_ago)
-        total_codes_sold += count
-        if count > top_buyer_count:
-            top_buyer_count = count
-            top_buyer_id = user
-    for user, charge in USER_CHARGED.items():
-        total_charge += charge
-        if charge > highest_charge:
-            highest_charge = charge
-    total_codes_available = 15  # Placeholder value
+    total_codes_sold = SALES_COUNTER.total(STATS_WINDOW_HOURS)
+    total_charge = CHARGE_COUNTER.total(STATS_WINDOW_HOURS)
+    highest_charge = CHARGE_COUNTER.peak(STATS_WINDOW_HOURS)
+    week_top = TOP_BUYERS["week"].items()
+    top_buyer_id, top_buyer_count = week_top[0] if week_top else (None, 0)
+    # The totals cover the last STATS_WINDOW_HOURS; the top buyer is kept per
+    # calendar week (from Saturday), so each line names its own window.
+    window = f"{STATS_WINDOW_HOURS // 24} روز اخیر"
     stats_msg = (
-        f"🎟کد های فروش رفته در هفته اخیر: {total_codes_sold}/{total_codes_available}\n"
-        f"💳کل مبلغ شارژ شده در این هفته: {total_charge}\n"
-        f"🥇بیشترین مبلغ شارژ شده در هفته اخیر: {highest_charge}\n"
-        f"🔹بیشترین خریدار کد: {top_buyer_id} | تعداد خرید: {top_buyer_count}"
+        f"🎟کد های فروش رفته در {window}: {total_codes_sold}/{total_codes_available()}\n"
+        f"💳کل مبلغ شارژ شده در {window}: {total_charge}\n"
+        f"🥇بیشترین مبلغ شارژ شده در {window}: {highest_charge}\n"
+        f"🔹بیشترین خریدار کد این هفته (از شنبه): {top_buyer_id} | تعداد خرید: {top_buyer_count}\n"
+        f"👥مخاطبان پیام همگانی: {len(REGISTERED_USERS) - sum(1 for user in DEAD_USERS if user in REGISTERED_USERS)}\n"
+        f"🚫کاربرانی که ربات را مسدود کرده‌اند: {len(DEAD_USERS)}"
     )
     await query.edit_message_text(stats_msg, reply_markup=get_admin_panel_keyboard())
 
+async def admin_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        await query.edit_message_text("دسترسی ندارید.")
+        return
+    lines = ["📦موجودی محصولات"]
+    for product in PRODUCT_PRICES.keys():
+        gauges = get_inventory(product)
+        lines.append(f"\n{product}\n"
+                     f"🎟باقی‌مانده: {gauges['remaining']}\n"
+                     f"🛍فروش امروز: {gauges['sold_today']} | 📈نرخ فروش موجودی: {sell_through_rate(gauges):.1f}%")
+    await query.edit_message_text("\n".join(lines), reply_markup=get_admin_panel_keyboard())
+
+async def admin_sales_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        await query.edit_message_text("دسترسی ندارید.")
+        return
+    this_month = datetime.datetime.utcnow().strftime("%Y-%m")
+    rows = [row for row in sales_rollup("monthly") if row[0] == this_month]
+    lines = [f"💰فروش ماه جاری ({this_month})"]
+    for _, product, units, revenue in rows:
+        lines.append(f"{product}: {units} عدد | مبلغ: {revenue}")
+    if not rows:
+        lines.append("هیچ فروشی ثبت نشده است.")
+    lines.append("\nخروجی CSV: /sales_csv daily|weekly|monthly")
+    await query.edit_message_text("\n".join(lines), reply_markup=get_admin_panel_keyboard())
+
+async def admin_sales_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("شما به این بخش دسترسی ندارید.")
+        return
+    period = context.args[0] if context.args else "daily"
+    if period not in ("daily", "weekly", "monthly"):
+        await update.message.reply_text("دوره نامعتبر است: daily، weekly یا monthly")
+        return
+    await update.message.reply_document(document=io.BytesIO(sales_csv(period)), filename=f"sales_{period}.csv")
+
+async def admin_top_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        await query.edit_message_text("دسترسی ندارید.")
+        return
+    msg = (format_top_k(f"🛍{TOP_K_SIZE} خریدار برتر (تعداد خرید)", TOP_BUYERS) + "\n\n" +
+           format_top_k(f"💳{TOP_K_SIZE} شارژکننده برتر (مبلغ)", TOP_CHARGERS))
+    await query.edit_message_text(msg, reply_markup=get_admin_panel_keyboard())
+
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -866,8 +2765,13 @@ async def add_code_filepath_handler(update: Update, context: ContextTypes.DEFAUL
         return ADD_CODE_FILEPATH
     SERVICE_CODES[service] = codes
     SERVICE_FILE_PATH[service] = file_path
+    restock_inventory(service, len(codes))
     await update.message.reply_text("کدها و مسیر فایل ثبت شدند✅", reply_markup=get_admin_panel_keyboard())
-    save_user_data()
+    schedule_user_data_save()
+    return ConversationHandler.END
+
+async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("عملیات لغو شد.")
     return ConversationHandler.END
 
 # =====================================================================
@@ -883,10 +2787,32 @@ async def panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 # Main Function - Register Handlers and Run the Bot
 # =====================================================================
 async def main():
-    # Load persistent user data at startup.
+    # Load persistent user data at startup. Purchase records refer to the
+    # sales series' product ids, so those are loaded first.
+    load_sales_series()
     load_user_data()
-    application = Application.builder().token("7039579736:AAFmD5CePJj47IESG157aG7UxaJVQGcLXEk").build()
+    load_registered_users()
+    rebuild_segment_indexes()
+    rebuild_all_time_top_k()
+    rebuild_user_columns()
+    rebuild_sales_velocity()
+    application = (
+        Application.builder()
+        .token("7039579736:AAFmD5CePJj47IESG157aG7UxaJVQGcLXEk")
+        .persistence(SQLitePersistence(ConversationDatabase(CONVERSATION_DB_FILE), CONVERSATION_PERSIST_INTERVAL))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
+    # Sees every update before the handlers below; feeds user_context_cleanup_worker().
+    application.add_handler(TypeHandler(Update, note_user_activity), group=-1)
+    # Runs before every conversation, so album items that arrive after the
+    # admin sent the album are not taken for input of another flow.
+    application.add_handler(MessageHandler(filters.User(ADMIN_ID) & (filters.PHOTO | filters.VIDEO | filters.Document.ALL),
+                                           drop_late_album_item), group=-2)
+
     # ---------------- User Handlers ----------------
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.Regex("^خرید محصول 🛍$"), buy_product))
@@ -901,139 +2827,204 @@ async def main():
     # ---------------- Admin Panel Command ----------------
     # Only admin can use /panel command
     application.add_handler(CommandHandler("panel", panel_handler))
+    application.add_handler(CommandHandler("broadcasts", admin_broadcast_jobs))
+    application.add_handler(CommandHandler("bpause", admin_broadcast_pause))
+    application.add_handler(CommandHandler("bresume", admin_broadcast_resume))
+    application.add_handler(CommandHandler("bcancel", admin_broadcast_cancel))
+    application.add_handler(CommandHandler("sales_csv", admin_sales_csv))
+    application.add_handler(CommandHandler("purchase_archive", admin_purchase_archive))
+    application.add_handler(CommandHandler("fleet", admin_fleet_stats))
+    application.add_handler(CommandHandler("backup", admin_backup))
     
     # ---------------- Conversation Handlers for Admin ----------------
     admin_add_code_conv = ConversationHandler(
+        name="admin_add_code",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_add_code_entry, pattern="^admin_add_code$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("addcode_service")],
             ADD_CODE_SERVICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_service_name)],
             ADD_CODE_FILEPATH: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_code_filepath_handler)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda update, context: update.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_add_code_conv)
     
     admin_add_credit_conv = ConversationHandler(
+        name="admin_add_credit",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_add_credit_start(u, c), pattern="^admin_add_credit$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("admin_credit_amount")],
             ADMIN_ADD_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_credit_amount)],
             ADMIN_ADD_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_credit_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_add_credit_conv)
     
     admin_subtract_credit_conv = ConversationHandler(
+        name="admin_subtract_credit",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_subtract_credit_start(u, c), pattern="^admin_subtract_credit$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("admin_sub_amount")],
             ADMIN_SUB_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_subtract_credit_amount)],
             ADMIN_SUB_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_subtract_credit_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_subtract_credit_conv)
     
     admin_unblock_conv = ConversationHandler(
+        name="admin_unblock",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_unblock_start(u, c), pattern="^admin_unblock$")],
         states={
             ADMIN_UNBLOCK_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_unblock_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_unblock_conv)
     
     admin_ban_conv = ConversationHandler(
+        name="admin_ban",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_ban_start(u, c), pattern="^admin_ban$")],
         states={
             ADMIN_BAN_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_ban_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_ban_conv)
     
     admin_message_conv = ConversationHandler(
+        name="admin_message",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_message_start(u, c), pattern="^admin_message$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("admin_target")],
             ADMIN_MESSAGE_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_userid)],
             ADMIN_MESSAGE_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_text)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_message_conv)
     
     admin_balance_conv = ConversationHandler(
+        name="admin_balance",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_balance_start(u, c), pattern="^admin_balance$")],
         states={
             ADMIN_BALANCE_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_balance_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_balance_conv)
     
     admin_recent_purchases_conv = ConversationHandler(
+        name="admin_recent_purchases",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_recent_purchases_start(u, c), pattern="^admin_recent_purchases$")],
         states={
             ADMIN_RECENT_PURCHASES_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_recent_purchases_userid)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_recent_purchases_conv)
     
     admin_broadcast_conv = ConversationHandler(
+        name="admin_broadcast",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_broadcast_start(u, c), pattern="^admin_broadcast$")],
         states={
-            ADMIN_BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_message)]
+            ConversationHandler.TIMEOUT: [
+                conversation_timed_out("broadcast_segment", "broadcast_album", "broadcast_album_id")],
+            ADMIN_BROADCAST_SEGMENT: [CallbackQueryHandler(admin_broadcast_segment, pattern="^segment_")],
+            ADMIN_BROADCAST_MESSAGE: [MessageHandler(BROADCAST_CONTENT_FILTER, admin_broadcast_message)],
+            ADMIN_BROADCAST_ALBUM: [
+                MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, admin_broadcast_album_item),
+                CallbackQueryHandler(admin_broadcast_album_send, pattern="^album_send$"),
+            ]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_broadcast_conv)
     
     admin_increase_conv = ConversationHandler(
+        name="admin_increase",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_increase_start(u, c), pattern="^admin_increase_price$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("increase_product")],
             INCREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_increase_select, pattern="^increase_")],
             INCREASE_PRODUCT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_increase_input)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_increase_conv)
     
     admin_decrease_conv = ConversationHandler(
+        name="admin_decrease",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_decrease_start(u, c), pattern="^admin_decrease_price$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("decrease_product")],
             DECREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_decrease_select, pattern="^decrease_")],
             DECREASE_PRODUCT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_decrease_input)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_decrease_conv)
     
     admin_delete_code_conv = ConversationHandler(
+        name="admin_delete_code",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(lambda u, c: admin_delete_code_start(u, c), pattern="^admin_delete_code$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("delete_service")],
             ADMIN_DELETE_CODE_SERVICE: [CallbackQueryHandler(admin_delete_code_select, pattern="^delete_")],
             ADMIN_DELETE_CODE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_delete_code_input)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_delete_code_conv)
     
     admin_add_button_conv = ConversationHandler(
+        name="admin_add_button",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_add_button_start, pattern="^admin_add_button$")],
         states={
+            ConversationHandler.TIMEOUT: [conversation_timed_out("new_button_name")],
             ADD_BUTTON_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_button_name)],
             ADD_BUTTON_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_button_price)]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_add_button_conv)
     
     admin_remove_button_conv = ConversationHandler(
+        name="admin_remove_button",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         entry_points=[CallbackQueryHandler(admin_remove_button_start, pattern="^admin_remove_button$")],
         states={
             REMOVE_BUTTON_SELECT: [CallbackQueryHandler(admin_remove_button_select, pattern="^remove_")]
         },
-        fallbacks=[MessageHandler(filters.COMMAND, lambda u, c: u.message.reply_text("عملیات لغو شد."))]
+        fallbacks=[MessageHandler(filters.COMMAND, cancel_conversation)]
     )
     application.add_handler(admin_remove_button_conv)
     
@@ -1041,6 +3032,10 @@ async def main():
     application.add_handler(CallbackQueryHandler(admin_turn_on_bot, pattern="^admin_turn_on_bot$"))
     application.add_handler(CallbackQueryHandler(admin_turn_off_bot, pattern="^admin_turn_off_bot$"))
     application.add_handler(CallbackQueryHandler(admin_stats, pattern="^admin_stats$"))
+    application.add_handler(CallbackQueryHandler(admin_top_users, pattern="^admin_top_users$"))
+    application.add_handler(CallbackQueryHandler(admin_inventory, pattern="^admin_inventory$"))
+    application.add_handler(CallbackQueryHandler(admin_sales_report, pattern="^admin_sales_report$"))
+    application.add_handler(CallbackQueryHandler(admin_recent_purchases_page, pattern="^purchasespage_"))
     
     application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
     